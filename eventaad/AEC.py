@@ -17,6 +17,7 @@ from .EEGModels import *
 from .convLSTM import ConvLSTM
 from utils.utils import *
 from utils import logging
+from utils.checkpoint import checkpoints
 logger = logging.getLogger()
 
 class LinearClassifier(nn.Module):
@@ -120,11 +121,11 @@ class AECNet(BaseNet):
                     #nn.init.normal_(param)
         if self.pretrained is not None:
             logger.info(f'Loading pretrained model: {self.pretrained}')
-            states = torch.load(self.pretrained)
+            states = checkpoints.load(self.pretrained)
             self.load_state_dict(states)
         if self.pretrained_feature_extractor is not None:
             logger.info(f'Loading pretrained feature extractor: {self.pretrained_feature_extractor}')
-            states = torch.load(self.pretrained_feature_extractor)
+            states = checkpoints.load(self.pretrained_feature_extractor)
             self.feature_extractor.load_state_dict(states)
         if self.feature_freeze:
             logger.info('freezing feature')
@@ -132,7 +133,7 @@ class AECNet(BaseNet):
                 param.requires_grad = False
         if self.pretrained_classifier is not None:
             logger.info(f'Loading pretrained classifier: {self.pretrained_classifier}')
-            states = torch.load(self.pretrained_classifier)
+            states = checkpoints.load(self.pretrained_classifier)
             self.classifier.load_state_dict(states)
         if self.classifier_freeze:
             logger.info('freezing classifier')
@@ -3,12 +3,33 @@ import numpy as np
 import torch
 from torch.utils.data import Dataset
 
+class SubjectIndex:
+    """
+    Maps flat epoch indexes to subject indexes by binary search over the cumulative
+    epoch counts.
+    """
+    def __init__(self, epoch_nums):
+        self.offsets = np.concatenate(([0], np.cumsum(epoch_nums))).astype(np.int64)
+        # subject id of every epoch, for fetching batches without lookups.
+        self.sbj_ids = np.repeat(np.arange(len(epoch_nums)), epoch_nums)
+        
+    def __len__(self):
+        return len(self.offsets) - 1
+        
+    def __call__(self, idx):
+        sbj_idx = np.searchsorted(self.offsets, idx, side='right') - 1
+        return int(sbj_idx) if np.ndim(sbj_idx) == 0 else sbj_idx
+        
+    def epochs(self, sbj_idx):
+        """Flat epoch indexes of subject sbj_idx."""
+        return np.arange(self.offsets[sbj_idx], self.offsets[sbj_idx+1])
+
 class ERPDataset(ABC, Dataset):
     """
     Abstract class for general ERP classification.
     """    
     @abstractmethod
-    def __init__(self, n_sbjs, X, y, ERP, channels_in, channels_erp, n_types, sr, scaler=None):
+    def __init__(self, n_sbjs, X, y, ERP, channels_in, channels_erp, n_types, sr, scaler=None, epoch_nums=None, value_range=None):
         Dataset.__init__(self)
         self.n_sbjs = n_sbjs
         self.X = X
@@ -18,19 +39,35 @@ class ERPDataset(ABC, Dataset):
         self.channels_erp = channels_erp
         self.n_types = n_types
         self.sr = sr
-        self.data_shape = self.X.shape
-        self.max_value = np.amax(self.X)
-        self.min_value = np.amin(self.X)
+        self.data_shape = (len(self.y),) + self.X.shape[1:]
+        # (min, max) of X, when already collected while scaling
+        self.min_value, self.max_value = (np.amin(self.X), np.amax(self.X)) if value_range is None else value_range
         self.scaler = scaler
-        pass
+        self.sbj_index = SubjectIndex([len(self.y)] if epoch_nums is None else epoch_nums)
+        self.sbj_ids = self.sbj_index.sbj_ids
         
     def __len__(self):
         return len(self.y)        
         
     def __getitem__(self, idx):
+        if not np.isscalar(idx):
+            return self.__getitems__(idx)
         erp = self.__get_ERP__(idx)
         sbj_idx = self.__get_sbj_idx__(idx)
-        return (torch.tensor(self.X[idx]),torch.tensor(erp), torch.tensor(self.y[idx], dtype=torch.float), sbj_idx)
+        return (torch.tensor(self.__get_X__(idx)),torch.tensor(erp), torch.tensor(self.y[idx], dtype=torch.float), sbj_idx)
+        
+    def __getitems__(self, idxs):
+        """
+        Fetching a batch of epochs as stacked tensors (X, ERP, y, subject ids), each
+        gathered once from the epoch arrays and wrapped without copying.
+        The batch is already collated, DataLoaders are built with `makeDataLoader`.
+        """
+        idxs = np.asarray(idxs, dtype=np.int64)
+        X = torch.from_numpy(np.ascontiguousarray(self.__get_X__(idxs)))
+        erp = torch.from_numpy(np.ascontiguousarray(self.__get_ERP__(idxs)))
+        y = torch.from_numpy(self.y[idxs].astype(np.float32))
+        sbj_idx = torch.from_numpy(self.sbj_ids[idxs])
+        return (X, erp, y, sbj_idx)
         
     def __visualize__(self, X, ERP, y, idx):
         """
@@ -53,13 +90,15 @@ class ERPDataset(ABC, Dataset):
         plt.show()
         plt.close()        
     
+    def __get_X__(self, idx):
+        return self.X[idx]
+        
     @abstractmethod
     def __get_ERP__(self, idx):
         pass
         
-    @abstractmethod
     def __get_sbj_idx__(self, idx):
-        pass        
+        return self.sbj_index(idx)
         
     @abstractmethod
     def __up_sampling__(self):
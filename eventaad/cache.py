@@ -0,0 +1,151 @@
+import os
+import json
+import hashlib
+import random
+import joblib
+from functools import partial
+import numpy as np
+from .store import INDEX_FILE, source_fingerprint
+from utils import logging
+logger = logging.getLogger()
+
+CACHE_EXT = '.pkl'
+# layout of the cache entries, part of every key
+CACHE_VERSION = 2
+# dataset config keys that do not change the built datasets
+RUN_KEYS = ('folder', 'pre_processed', 'cache', 'cache_size', 'build_workers', 'num_sbjs', 'from_sbj', 'to_sbj', 'leave_one_out', 'seed')
+
+def get_rng_state():
+    return np.random.get_state(), random.getstate()
+
+def set_rng_state(state):
+    np.random.set_state(state[0])
+    random.setstate(state[1])
+
+def seed_rng(seed):
+    np.random.seed(seed)
+    random.seed(seed)
+    
+def getSeed(dataset_params):
+    return dataset_params['seed'] if 'seed' in dataset_params else None
+
+def hash_parts(h, part):
+    if isinstance(part, np.ndarray):
+        h.update(str((part.dtype, part.shape)).encode())
+        h.update(np.ascontiguousarray(part).tobytes())
+    elif isinstance(part, (list, tuple)):
+        h.update(f'[{len(part)}'.encode())
+        for item in part:
+            hash_parts(h, item)
+    else:
+        h.update(json.dumps(part, sort_keys=True, default=str).encode())
+
+class DatasetCache:
+    """On-disk cache of built datasets, addressed by a hash of everything they are built from.
+
+    Entries are joblib files opened with `mmap_mode='r'`, so the epoch arrays of a cached
+    dataset are paged in on demand and shared by all processes reading the same entry.
+    The least recently used entries are evicted once the folder exceeds max_size (GB).
+    """
+    def __init__(self, folder, max_size=None):
+        self.folder = folder
+        self.max_bytes = None if max_size is None else int(max_size*2**30)
+        os.makedirs(folder, exist_ok=True)
+
+    def key(self, *parts):
+        h = hashlib.sha1()
+        hash_parts(h, parts)
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.folder, key + CACHE_EXT)
+
+    def load(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        logger.info(f'Loading cached dataset: {path}')
+        entry = joblib.load(path, mmap_mode='r')
+        os.utime(path) # last use for the eviction
+        return entry
+
+    def save(self, key, entry):
+        path = self.path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        joblib.dump(entry, tmp_path)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+        entries = []
+        for f in os.listdir(self.folder):
+            if f.endswith(CACHE_EXT):
+                st = os.stat(os.path.join(self.folder, f))
+                entries.append((st.st_mtime, st.st_size, f))
+        total = sum(size for _, size, _ in entries)
+        for _, size, f in sorted(entries)[:-1]:
+            if total <= self.max_bytes:
+                break
+            logger.info(f'Evicting cached dataset: {f}')
+            os.remove(os.path.join(self.folder, f))
+            total -= size
+
+def getDatasetCache(dataset_params):
+    if 'cache' not in dataset_params or dataset_params['cache'] is None:
+        return None
+    max_size = dataset_params['cache_size'] if 'cache_size' in dataset_params else None
+    return DatasetCache(os.path.expandvars(dataset_params['cache']), max_size)
+
+def getScalerFingerprint(dataset_params):
+    scaler_path = dataset_params['scaler']['path']
+    scaler_path = os.path.expandvars(scaler_path) if scaler_path is not None else None
+    return source_fingerprint(scaler_path) if scaler_path is not None and os.path.exists(scaler_path) else None
+
+def seededBuild(build, seed):
+    """build() with numpy/random seeded by seed, the global states are restored afterwards."""
+    state = get_rng_state()
+    seed_rng(seed)
+    try:
+        return build()
+    finally:
+        set_rng_state(state)
+
+def cachedBuild(build, dataset_params, loaded_data, *parts, use_rng=True, key_config=None):
+    """Return build(), through the dataset cache of dataset_params when it is set.
+
+    The key covers the dataset config, the epoch store of loaded_data, the scaler file,
+    the given parts (splits, subjects, ...) and, with use_rng, the `seed` of the config.
+    key_config replaces the dataset config in the key when only some of its entries affect
+    the build. A build that fits and saves the scaler is stored under the key of the
+    saved scaler file, so that it is hit by the following runs.
+    Such builds draw from numpy/random seeded by the seed, the config and the parts, so
+    a build only depends on its key. The global states of the caller are restored after
+    the build, so they do not depend on whether the cache was hit. Without a seed the
+    builds depend on the unseeded global state and are never cached.
+    """
+    config = key_config
+    if config is None:
+        config = {k: v for k, v in dataset_params.items() if k not in RUN_KEYS}
+    seed = getSeed(dataset_params)
+    if use_rng:
+        if seed is None:
+            return build()
+        h = hashlib.sha1()
+        hash_parts(h, (seed, config, parts))
+        build = partial(seededBuild, build, int(h.hexdigest()[:8], 16))
+    cache = getDatasetCache(dataset_params)
+    if cache is None or 'store' not in loaded_data:
+        return build()
+    source = source_fingerprint(os.path.join(loaded_data['store'], INDEX_FILE))
+    make_key = lambda scaler: cache.key(CACHE_VERSION, config, source, scaler, seed if use_rng else None, *parts)
+    scaler = getScalerFingerprint(dataset_params)
+    result = cache.load(make_key(scaler))
+    if result is not None:
+        return result
+    result = build()
+    if scaler is None:
+        scaler = getScalerFingerprint(dataset_params)
+    cache.save(make_key(scaler), result)
+    return result
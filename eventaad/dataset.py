@@ -1,20 +1,28 @@
 import os
 import numpy as np
 import random
+import copy
 import matplotlib.pyplot as plt
 import pandas as pd
 from sklearn.preprocessing import MinMaxScaler, RobustScaler
 from scipy.signal import resample
+from scipy import sparse
 import mne
 import joblib
 import torch
 import math
 import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader, ConcatDataset
+from torch.utils.data import Dataset, DataLoader, ConcatDataset, RandomSampler, SequentialSampler
 import torchaudio.transforms as T
+from numpy.lib.stride_tricks import sliding_window_view
 from utils import logging
 logger = logging.getLogger()
-from .ERPDataset import ERPDataset
+from .ERPDataset import ERPDataset, SubjectIndex
+from .scaler import affine_params, fitScaler, scaleInplace
+from .cache import get_rng_state, set_rng_state
+from utils.pool import pool_imap
+from .store import getStorePath, isStoreValid, convertERPdata, loadERPstore, getTrialFiles, convertMATdata, loadMATstore, shareArray, openSharedArray
+from scipy.io import loadmat
 
 MIN_LATENCY = 0.2
 MAX_LATENCY = 0.7
@@ -25,7 +33,7 @@ PRE_STIMULUS = 0.2
 def nan_helper(y):
     return np.isnan(y), lambda z: z.nonzero()[0]
 
-def make_conv(X, y, z, evt_y=None, evt_z=None,  eeg_context=1, aud_context=1, padding=0):
+def make_conv(X, y, z, evt_y=None, evt_z=None,  eeg_context=1, aud_context=1, padding=0, as_view=False, dtype=np.float64):
     """Return A matrix and b vector for Aw=b.
     
     Arguments
@@ -34,6 +42,9 @@ def make_conv(X, y, z, evt_y=None, evt_z=None,  eeg_context=1, aud_context=1, pa
     y : array, (time sample) attd envelope
     z : array, (time sample) unattended envelope
     num_context : scalar, number of time samples in a frame aka number of columns in A.
+    as_view : bool, return read-only strided views over the padded inputs instead of copies.
+              X_out is then (num frames, num_ch, num_context), reshaping it gives the layout below.
+    dtype : dtype of the materialized outputs, ignored when as_view is True.
     
     Returns
     -------
@@ -47,7 +58,8 @@ def make_conv(X, y, z, evt_y=None, evt_z=None,  eeg_context=1, aud_context=1, pa
     (num_ch,L) = X.shape
     # interpolate NaN values.
     nans, x = nan_helper(X)
-    X[nans]= np.interp(x(nans), x(~nans), X[~nans])
+    if nans.any():
+        X[nans]= np.interp(x(nans), x(~nans), X[~nans])
     
     X = np.pad(X, pad_width=((0,0),(0,eeg_context-1)), constant_values=padding)
     y = np.pad(y, pad_width=((aud_context-1,0)), constant_values=padding)
@@ -57,27 +69,93 @@ def make_conv(X, y, z, evt_y=None, evt_z=None,  eeg_context=1, aud_context=1, pa
     if evt_z is not None:
         evt_z = np.pad(evt_z, pad_width=((aud_context-1,0)), constant_values=padding)          
 
-    # Create output:  
-    num_output = X.shape[-1] - eeg_context + 1
-    X_out = np.nan * np.ones((num_output, eeg_context * num_ch))
-    y_out = np.nan * np.ones((num_output, aud_context))
-    z_out = np.nan * np.ones((num_output, aud_context))
-    evt_y_out = np.nan * np.ones((num_output, aud_context)) if evt_y is not None else None 
-    evt_z_out = np.nan * np.ones((num_output, aud_context))  if evt_z is not None else None    
-    for idx in range(num_output):
-        eeg_idx_keep = idx + np.arange(eeg_context)
-        X_out[idx] = np.ravel(X[:, eeg_idx_keep])
-        aud_idx_keep = idx + np.arange(aud_context)
-        y_out[idx] = np.ravel(y[..., aud_idx_keep])  
-        z_out[idx] = np.ravel(z[..., aud_idx_keep])    
-        if evt_y is not None:
-            evt_y_out[idx] = np.ravel(evt_y[..., aud_idx_keep])
-        if evt_z is not None:
-            evt_z_out[idx] = np.ravel(evt_z[..., aud_idx_keep])  
+    # Create output as strided windows: frame idx sees samples idx ... idx+context-1.
+    X_out = sliding_window_view(X, eeg_context, axis=-1).transpose(1, 0, 2)
+    y_out = sliding_window_view(y, aud_context)
+    z_out = sliding_window_view(z, aud_context)
+    evt_y_out = sliding_window_view(evt_y, aud_context) if evt_y is not None else None 
+    evt_z_out = sliding_window_view(evt_z, aud_context) if evt_z is not None else None    
+    if as_view:
+        return X_out, y_out, z_out, evt_y_out, evt_z_out
     
+    num_output = X_out.shape[0]
+    X_flat = np.empty(X_out.shape, dtype=dtype)
+    X_flat[...] = X_out
+    X_out = X_flat.reshape(num_output, -1)
+    y_out = y_out.astype(dtype)
+    z_out = z_out.astype(dtype)
+    evt_y_out = evt_y_out.astype(dtype) if evt_y is not None else None
+    evt_z_out = evt_z_out.astype(dtype) if evt_z is not None else None
     return X_out, y_out, z_out, evt_y_out, evt_z_out
 
-def getLinearEnvelopeData(loaded_data, config, trial_idxs):       
+class LagMatrix:
+    """Lazy EEG matrix of make_conv for one trial.
+
+    Only the padded (ch, time + context - 1) EEG is kept in memory, frames are cut
+    from a read-only strided view and flattened on demand (ch0 t0..tN, ch1 ...).
+    """
+    def __init__(self, X_view, dtype=np.float32):
+        # rebuild the padded signal from the (frames, ch, context) make_conv view.
+        self.context = X_view.shape[-1]
+        self.X = np.concatenate((X_view[:,:,0].T, X_view[-1,:,1:]), axis=-1).astype(dtype)
+        
+    def __len__(self):
+        return self.X.shape[-1] - self.context + 1
+        
+    @property
+    def shape(self):
+        return (len(self), self.X.shape[0]*self.context)
+        
+    def view(self):
+        return sliding_window_view(self.X, self.context, axis=-1).transpose(1, 0, 2)
+        
+    def __getitem__(self, idx):
+        frames = self.view()[idx]
+        return frames.reshape(frames.shape[:-2] + (-1,))
+        
+    def transform(self, scaler):
+        """Apply an elementwise (1 feature) scaler in place."""
+        scaleInplace(self.X, scaler)
+
+def makeEventIndex(events, n_samples, windows, sr, eeg_context):
+    """Start offsets of the event-locked decoding windows.
+
+    Arguments
+    ---------
+    events : int array (num events,), event locations in samples.
+    n_samples : int, length of the envelope the windows are taken from.
+    windows : list of window lengths in seconds.
+    eeg_context : scalar, EEG context the windows are shifted by, as given to
+        `trainLinearEnvelope`.
+
+    Returns
+    -------
+    starts : int array (num events, num windows), -1 where the window does not fit.
+    """
+    events = np.asarray(events, dtype=np.int64).reshape(-1, 1)
+    windows = np.asarray(windows, dtype=np.float64).reshape(1, -1)
+    lengths = (windows*sr).astype(np.int64)
+    starts = events - ((windows-eeg_context)*sr/2).astype(np.int64)
+    valid = (starts >= 0) & (starts+lengths <= n_samples)
+    return np.where(valid, starts, -1)
+
+def loadLinearData(mat_path, use_store=True):
+    """Load a preprocessed `.mat` subject, through its trial store when use_store is set."""
+    if use_store:
+        store_path = getStorePath(mat_path)
+        if not isStoreValid(mat_path, store_path, getTrialFiles()):
+            convertMATdata(mat_path, store_path)
+        return loadMATstore(store_path)
+    return loadmat(mat_path, squeeze_me=True)
+
+def getLinearEnvelopeData(loaded_data, config, trial_idxs, lazy=False):
+    """Build the backward-model data of one subject.
+
+    With lazy=True the EEG is returned as a list of per-trial LagMatrix instead of the
+    concatenated lag matrix, so only (ch, time) samples are held in memory.
+    The last returned item is the event index, the window starts of every attended and
+    unattended event for the `windows` of config (see makeEventIndex).
+    """
     sr = loaded_data['sr']
     chns = loaded_data['channels']
     eegs = loaded_data['eeg']
@@ -105,7 +183,11 @@ def getLinearEnvelopeData(loaded_data, config, trial_idxs):
         y_true = y_trues[i]-1
         attd_env = envs[i].T[y_true]
         unattd_env = envs[i].T[1-y_true]
-        eeg, attd_env, unattd_env, _, _ = make_conv(eeg, attd_env, unattd_env, eeg_context=eeg_context, aud_context=aud_context)
+        eeg, attd_env, unattd_env, _, _ = make_conv(eeg, attd_env, unattd_env, eeg_context=eeg_context, aud_context=aud_context, as_view=lazy)
+        if lazy:
+            eeg = LagMatrix(eeg)
+            attd_env = attd_env.astype(np.float64)
+            unattd_env = unattd_env.astype(np.float64)
         groups = list(trial_idxs).index(i) * np.ones(eeg.shape[0])
         eeg_all.append(eeg)
         attd_env_all.append(attd_env)
@@ -118,13 +200,20 @@ def getLinearEnvelopeData(loaded_data, config, trial_idxs):
     
     del eegs, envs, y_trues
     
-    eeg_all = np.concatenate(eeg_all, axis=0)
+    if not lazy:
+        eeg_all = np.concatenate(eeg_all, axis=0)
     attd_env_all = np.concatenate(attd_env_all, axis=0)
     unattd_env_all = np.concatenate(unattd_env_all, axis=0)
     attd_evt_all = np.concatenate(attd_evt_all)
     unattd_evt_all = np.concatenate(unattd_evt_all)
     groups_all = np.concatenate(groups_all, axis=0)
-    n_samples = eeg_all.shape[0]
+    n_samples = data_len
+    windows = config['windows'] if 'windows' in config else []
+    evt_index = {
+        'windows': list(windows),
+        'attd': makeEventIndex(attd_evt_all, n_samples, windows, sr, eeg_context),
+        'unattd': makeEventIndex(unattd_evt_all, n_samples, windows, sr, eeg_context),
+    }
     
     # eeg scaling
     scaler_path = config['scaler']['path']
@@ -140,30 +229,40 @@ def getLinearEnvelopeData(loaded_data, config, trial_idxs):
                 scaler = MinMaxScaler(feature_range=feature_range)
             elif config['scaler']['type'] == 'RobustScaler':
                 scaler = RobustScaler(quantile_range=(5.0, 95.0))   
-            scaler.fit_transform(eeg_all.reshape(-1,1))
+            if lazy:
+                # fitted on the padded samples, not on every lagged copy of them.
+                scaler.fit(np.concatenate([eeg.X.ravel() for eeg in eeg_all]).reshape(-1,1))
+            else:
+                scaler.fit_transform(eeg_all.reshape(-1,1))
     if scaler is not None:
-        eeg_all = scaler.transform(eeg_all.reshape(-1,1)).reshape(n_samples, -1)
+        if lazy:
+            for eeg in eeg_all:
+                eeg.transform(scaler)
+        else:
+            scaleInplace(eeg_all, scaler)
     
     # audio scaling  
     audio_scaler = RobustScaler(quantile_range=(0.1, 99.9))
     attd_env_all = audio_scaler.fit_transform(attd_env_all)
     unattd_env_all = audio_scaler.fit_transform(unattd_env_all)
                 
-    return eeg_all, attd_env_all, unattd_env_all, attd_evt_all, unattd_evt_all, groups_all 
+    return eeg_all, attd_env_all, unattd_env_all, attd_evt_all, unattd_evt_all, groups_all, evt_index
 
 def makeSinERP(length, ERP_ltc, erp_w, sr, amps, snr=0):
-    chns = len(amps.shape)
-    nepochs = len(ERP_ltc)
-    erp = np.zeros((nepochs, chns, 5*length))
-    #
-    for i in range(nepochs):   
-        t = np.arange(erp_w[i])
-        sin = np.sin(np.pi/erp_w[i]*t)
-        erp[i,:,2*length:2*length+erp_w[i]] = erp[i,:,2*length:2*length+erp_w[i]] + sin
-        erp[i] = np.roll(erp[i], shift=(ERP_ltc[i]-erp_w[i]/2).astype(int), axis=-1)
-    scaler = np.sqrt(10**(snr/10))
-    erp = scaler*np.expand_dims(amps, axis=-1)*erp[...,2*length:3*length]   
-    return erp
+    """
+    Half-sine ERPs of width erp_w centred at ERP_ltc (samples), (nepochs, chns, length)
+    float32, built for all epochs at once. The waveform positions are those of the
+    half-sine rolled around a 5*length buffer whose middle third is kept.
+    """
+    ERP_ltc = np.asarray(ERP_ltc)
+    erp_w = np.asarray(erp_w)
+    shift = (ERP_ltc-erp_w/2).astype(int)
+    # sample of the half-sine that lands on every output sample
+    t = (2*length + np.arange(length)[None,:] - shift[:,None]) % (5*length) - 2*length
+    w = erp_w[:,None]
+    erp = np.where((t >= 0) & (t < w), np.sin(np.pi/w*t), 0).astype(np.float32)
+    scaler = np.float32(np.sqrt(10**(snr/10)))
+    return scaler*np.asarray(amps, dtype=np.float32)[None,:,None]*erp[:,None,:]
 
 def findERPWidth(erp, min_w, max_w):
     cross = []
@@ -183,31 +282,64 @@ def findERPWidth(erp, min_w, max_w):
     return w
     
 def makeRealERP(length, ERP_ltc, erp_w, sr, grand_erps, grand_ltc, grand_w, snr=0):
+    """
+    Grand ERPs stretched to width erp_w with their peak moved to ERP_ltc (samples),
+    (nepochs, chns, length) float32. The grand ERP is resampled once per unique width
+    and gathered into all epochs of that width.
+    """
+    ERP_ltc = np.asarray(ERP_ltc)
+    erp_w = np.asarray(erp_w)
     chns = len(grand_erps)
     nepochs = len(ERP_ltc)
-    erp = np.zeros((nepochs, chns, 5*length))
+    erp = np.zeros((nepochs, chns, length), dtype=np.float32)
     # find grand ERP width
     w_scale = erp_w/grand_w
     new_len = (length*w_scale).astype(int)
     new_grand_ltc = (grand_ltc*w_scale).astype(int)
-    for i in range(nepochs):
-        new_erp = resample(grand_erps, new_len[i], axis=1)
-        erp[i,:,2*length+ERP_ltc[i]-new_grand_ltc[i]:2*length+ERP_ltc[i]-new_grand_ltc[i]+new_len[i]] = new_erp
-    scaler = np.sqrt(10**(snr/10))
-    erp = scaler*erp[...,2*length:3*length] 
-    return erp    
+    t = np.arange(length)
+    for w in np.unique(erp_w):
+        epochs = np.nonzero(erp_w == w)[0]
+        n = new_len[epochs[0]]
+        new_erp = resample(grand_erps, n, axis=1).astype(np.float32)
+        new_erp = np.concatenate((new_erp, np.zeros((chns, 1), dtype=np.float32)), axis=1)
+        # sample of the resampled ERP that lands on every output sample, n for none
+        src = t[None,:] - ERP_ltc[epochs,None] + new_grand_ltc[epochs,None]
+        src = np.where((src >= 0) & (src < n), src, n)
+        erp[epochs] = new_erp[:,src].transpose(1, 0, 2)
+    scaler = np.float32(np.sqrt(10**(snr/10)))
+    return scaler*erp
+
+def averaging_matrix(idx, k, n_sources, dtype=np.float32, normalize=True):
+    """
+    Sparse (len(k), n_sources) matrix whose row r averages (sums if not normalize) the
+    sources listed in the next k[r] entries of idx (a source drawn twice counts twice).
+    """
+    k = np.asarray(k, dtype=np.int64)
+    rows = np.repeat(np.arange(len(k)), k)
+    weights = np.repeat(1.0/k if normalize else np.ones(len(k)), k).astype(dtype)
+    return sparse.csr_matrix((weights, (rows, idx)), shape=(len(k), n_sources))
 
-def sampling(X, y, n, min_seed, max_seed):
-    new_X = []
-    new_y = []
-    for i in range(n):
-        k = random.randint(min_seed, max_seed) # number of candidates used to generate new data point.
-        idx = np.random.choice(len(X), k)
-        new_X.append(X[idx,...].mean(axis=0, keepdims=True))
-        new_y.append(y[idx,...].mean(axis=0, keepdims=True))
-    return (np.concatenate(new_X, axis=0), np.concatenate(new_y, axis=0))
+def sampling(X, y, n, min_seed, max_seed, chunk_size=1024):
+    # number of candidates used to generate each new data point.
+    k = np.array([random.randint(min_seed, max_seed) for i in range(n)], dtype=np.int64)
+    idx = np.random.choice(len(X), k.sum())
+    W = averaging_matrix(idx, k, len(X), dtype=np.result_type(X.dtype, np.float32))
+    X_flat = np.asarray(X).reshape(len(X), -1)
+    new_X = np.empty((n,) + X.shape[1:], dtype=X.dtype)
+    for start in range(0, n, chunk_size):
+        new_X[start:start+chunk_size] = (W[start:start+chunk_size] @ X_flat).reshape((-1,) + X.shape[1:])
+    # labels are summed then divided, as mean() does.
+    W = averaging_matrix(idx, k, len(y), dtype=np.float64, normalize=False)
+    new_y = (W @ np.asarray(y, dtype=np.float64).reshape(len(y), -1))/k[:,None]
+    new_y = new_y.reshape((n,) + y.shape[1:])
+    return (new_X, new_y)
 
-def makeERPdata(ds_path):
+def makeERPdata(ds_path, use_store=True):
+    if use_store:
+        store_path = getStorePath(ds_path)
+        if not isStoreValid(ds_path, store_path):
+            convertERPdata(ds_path, store_path)
+        return loadERPstore(store_path)
     logger.info(f'loading raw dataset {ds_path}')
     loaded_data = dict(np.load(ds_path, allow_pickle=True))    
     X_raw = list(loaded_data['X'])
@@ -227,6 +359,23 @@ def makeERPdata(ds_path):
     loaded_data['y'] = list(loaded_data['y'])
     return loaded_data
 
+def makeERPdatasets(ds_paths, num_workers=1):
+    """makeERPdata of several files, the missing epoch stores are converted in parallel."""
+    missing = [ds_path for ds_path in ds_paths if not isStoreValid(ds_path, getStorePath(ds_path))]
+    for _ in pool_imap(convertERPdata, missing, num_workers=num_workers):
+        pass
+    return [makeERPdata(ds_path) for ds_path in ds_paths]
+
+def concat_crop(arrays, start, end, dtype=np.float32):
+    """Concatenate arrays (n, ..., L) along the first axis, cropped to [start, end) in time, in a single allocation."""
+    arrays = [np.asarray(a) for a in arrays]
+    out = np.empty((sum(len(a) for a in arrays),) + arrays[0][...,start:end].shape[1:], dtype=dtype)
+    offset = 0
+    for a in arrays:
+        out[offset:offset+len(a)] = a[...,start:end]
+        offset += len(a)
+    return out
+
 class ExperimentalERPDataset(ERPDataset):
     def __init__(self, config, loaded_data):
         channels = list(loaded_data['channels'])
@@ -246,88 +395,267 @@ class ExperimentalERPDataset(ERPDataset):
         self.X = loaded_data['X']
         self.y = loaded_data['y']
         self.n_sbjs = len(self.X)
-        if config['upsampling']:
-            self.__up_sampling__(config['factor'], config['min_seed'], config['max_seed'])
         raw_ERP = loaded_data['ERP'] if 'ERP' in loaded_data.keys() else None
-        self.ERP = self.__make_ERP_data__(raw_ERP, chn_idx_out)
+        self.virtual = config['upsampling'] and ('virtual' in config.keys() and config['virtual'])
+        num_workers = config['build_workers'] if 'build_workers' in config.keys() else 1
+        if self.virtual:
+            if raw_ERP is None:
+                raw_ERP = [[self.X[i][self.y[i] == label].mean(axis=0) for label in np.unique(self.y[i])] for i in range(self.n_sbjs)]
+            self.__virtual_up_sampling__(config['factor'], config['min_seed'], config['max_seed'])
+        elif config['upsampling']:
+            self.__up_sampling__(config['factor'], config['min_seed'], config['max_seed'], num_workers)
+        self.ERP, self.erp_index = self.__make_ERP_data__(raw_ERP, chn_idx_out, num_workers)
         self.epoch_nums = []
         for i in range(self.n_sbjs):
             self.epoch_nums.append(len(self.y[i]))
-        X = 1e6*np.concatenate(self.X, axis=0)[...,self.start:self.end].astype(np.float32)
-        ERP = 1e6*np.concatenate(self.ERP, axis=0)[...,self.start:self.end].astype(np.float32)
+        # cropped float32 copies, the 1e6 factor is applied together with the scaler.
+        X = concat_crop(self.X, self.start, self.end)
+        ERP = concat_crop([self.ERP], self.start, self.end)
         y = np.concatenate(self.y, axis=0).astype(np.int16)
         scaler = None
         if config['scaler']['type'] is not None:
             path = os.path.expandvars(config['scaler']['path'])
-            data_shape = X.shape
-            X = X.reshape(-1, 1)
             if os.path.exists(path):
                 scaler = joblib.load(path)
-                X = scaler.transform(X)
             else:
                 if config['scaler']['type'] == 'MinMaxScaler':
                     feature_range = tuple(config['scaler']['feature_range'])
                     scaler = eval(config['scaler']['type'])(feature_range=feature_range)
                 elif config['scaler']['type'] == 'RobustScaler':
                     scaler = eval(config['scaler']['type'])(quantile_range=(5.0, 95.0))   
-                X = scaler.fit_transform(X)
+                if self.virtual:
+                    # X only holds the source epochs, fit on the up-sampled epochs as the
+                    # non-virtual path does, synthesized chunk by chunk.
+                    self.X = X
+                    data = (self.__synthesize__(np.arange(start, min(start+1024, len(y)))) for start in range(0, len(y), 1024))
+                else:
+                    data = np.split(X, np.cumsum(self.epoch_nums)[:-1])
+                fitScaler(scaler, data, factor=1e6)
                 joblib.dump(scaler, path)
-            X = X.reshape(data_shape)
-            ERP_shape = ERP.shape
-            ERP = scaler.transform(ERP.reshape(-1, 1)).reshape(ERP_shape)        
-        super().__init__(self.n_sbjs, X, y, ERP, channels_in, channels_erp, config['ERP_types'], sr, scaler)
+        value_range = scaleInplace(X, scaler, factor=1e6)
+        scaleInplace(ERP, scaler, factor=1e6)
+        super().__init__(self.n_sbjs, X, y, ERP, channels_in, channels_erp, config['ERP_types'], sr, scaler, self.epoch_nums, value_range)
         logger.info(f'self.epoch_nums: {self.epoch_nums}')     
         
     def __get_ERP__(self, idx):
-        return self.ERP[idx]
+        # ERP targets are expanded from the templates at fetch time.
+        return self.ERP[self.erp_index[idx]]
+        
+    def __get_X__(self, idx):
+        if not self.virtual:
+            return self.X[idx]
+        X = self.__synthesize__(np.atleast_1d(idx))
+        return X if np.ndim(idx) else X[0]
         
-    def __get_sbj_idx__(self, idx):
-        # epoch_idx = self.epoch_indexes[idx]
-        sum_ipochs = 0
+    def __synthesize__(self, idxs):
+        """
+        Generating the epochs idxs from their descriptors, an averaged epoch is the mean
+        of k source epochs drawn from its pool by its own seed, so every worker
+        reproduces the same epoch. Averaging commutes with the (affine) scaler, the
+        already scaled source epochs are averaged.
+        """
+        if np.all(self.v_src[idxs] >= 0):
+            return self.X[self.v_src[idxs]]
+        members = []
+        for idx in idxs:
+            if self.v_src[idx] >= 0:
+                members.append(self.v_src[idx:idx+1])
+            else:
+                pool = self.v_pools[self.v_pool[idx]]
+                rng = np.random.default_rng(self.v_seed[idx])
+                members.append(pool[rng.integers(len(pool), size=self.v_k[idx])])
+        W = averaging_matrix(np.concatenate(members), self.v_k[idxs], len(self.X), dtype=self.X.dtype)
+        return (W @ self.X.reshape(len(self.X), -1)).reshape((len(idxs),) + self.X.shape[1:])
+
+    def source_rows(self):
+        """
+        Row of self.X that every epoch is equal to, -1 for the averages of several epochs.
+        Views of one base share self.X, their epochs with the same row are the same epoch.
+        """
+        if not self.virtual:
+            return np.arange(len(self.y))
+        rows = self.v_src.copy()
+        for idx in np.nonzero((rows < 0) & (self.v_k == 1))[0]:
+            # same draw as __synthesize__
+            pool = self.v_pools[self.v_pool[idx]]
+            rows[idx] = pool[np.random.default_rng(self.v_seed[idx]).integers(len(pool), size=1)[0]]
+        return rows
+
+    def __up_sampling__(self, factor, min_seed, max_seed, num_workers=1):
+        """
+        Class balancing of every subject over num_workers processes, see upSampleSubject.
+        Epochs of the memmapped store are passed to the workers by file and offset.
+        """
+        # every subject is up-sampled from its own seed, drawn once from the global RNG,
+        # so the dataset does not depend on the number of workers.
+        seed = np.random.randint(2**31-1)
+        jobs = [(i, shareArray(self.X[i]), self.y[i], np.random.SeedSequence([seed, i]).generate_state(1)[0]) for i in range(self.n_sbjs)]
+        params = {'factor': factor, 'min_seed': min_seed, 'max_seed': max_seed}
+        for job, (X, y) in pool_imap(upSampleSubject, jobs, params, num_workers):
+            self.X[job[0]], self.y[job[0]] = X, y
+        del jobs
+    
+    @staticmethod
+    def __up_sample_subject__(X, y, factor, min_seed, max_seed):
+        labels, weights = np.unique(y, return_counts=True)
+        new_X = []
+        new_y = []
+        for j in range(len(labels)):
+            X_j = X[y == labels[j]]
+            y_j = y[y == labels[j]]
+            # up-sampling for each class
+            X_new, y_new = sampling(X_j, y_j, factor*np.amax(weights), min_seed, max_seed)
+            new_X.append(X_new)
+            new_y.append(y_new)
+            # add original data points for each class equally
+            idx = random.sample(range(weights[j]), np.amin(weights))
+            new_X.append(X_j[idx])
+            new_y.append(y_j[idx])
+            del X_new, y_new
+        # the original data is discarded to have noise balanced dataset
+        return np.concatenate(new_X), np.concatenate(new_y)
+    
+    def __virtual_up_sampling__(self, factor, min_seed, max_seed, sources=None):
+        """
+        Same class balancing as __up_sampling__, but the averaged epochs are only kept as
+        (pool, k, seed) descriptors over the source epochs and synthesized at fetch time,
+        so memory does not grow with factor. Kept source epochs have v_src >= 0.
+        sources are the rows of the epochs of each subject in the source array, by
+        default the subjects are concatenated.
+        """
+        self.v_pools = []
+        src, pool, k, seed = [], [], [], []
+        offset = 0
         for i in range(self.n_sbjs):
-            sum_ipochs += self.epoch_nums[i]
-            if sum_ipochs>idx:
-                sbj_idx = i
-                break
-        return sbj_idx
+            labels, weights = np.unique(self.y[i], return_counts=True)
+            rows = np.arange(offset, offset+len(self.y[i])) if sources is None else sources[i]
+            y = []
+            for j in range(len(labels)):
+                members = rows[self.y[i] == labels[j]]
+                n = factor*np.amax(weights)
+                src.append(np.full(n, -1))
+                pool.append(np.full(n, len(self.v_pools)))
+                k.append(np.random.randint(min_seed, max_seed+1, n))
+                seed.append(np.random.randint(0, 2**31-1, n))
+                y.append(np.full(n, labels[j]))
+                self.v_pools.append(members)
+                # add original data points for each class equally
+                idx = random.sample(range(weights[j]), np.amin(weights))
+                src.append(members[idx])
+                pool.append(np.full(len(idx), -1))
+                k.append(np.ones(len(idx), dtype=int))
+                seed.append(np.zeros(len(idx), dtype=int))
+                y.append(self.y[i][self.y[i] == labels[j]][idx])
+            offset += len(self.y[i])
+            self.y[i] = np.concatenate(y)
+        self.v_src = np.concatenate(src)
+        self.v_pool = np.concatenate(pool)
+        self.v_k = np.concatenate(k)
+        self.v_seed = np.concatenate(seed)
+        
+    def view(self, epochs, config):
+        """
+        Dataset over a subset of the epochs of this (not up-sampled) dataset, sharing its
+        preprocessed epochs and ERP templates instead of copying them.
+        epochs are the epoch indexes of each subject of the view. With config['virtual'] the
+        up-sampled epochs are synthesized at fetch time, otherwise they are averaged here by
+        `sampling` into the own epoch array of the view, as __up_sampling__ does.
+        """
+        dataset = copy.copy(self)
+        dataset.n_sbjs = len(epochs)
+        dataset.y = [self.y[idxs] for idxs in epochs]
+        virtual = 'virtual' in config.keys() and config['virtual']
+        if config['upsampling'] and virtual:
+            dataset.__virtual_up_sampling__(config['factor'], config['min_seed'], config['max_seed'], epochs)
+            first = np.array([members[0] for members in dataset.v_pools])
+            rows = np.where(dataset.v_src >= 0, dataset.v_src, first[dataset.v_pool])
+        elif config['upsampling']:
+            rows = dataset.__view_up_sampling__(epochs, config['factor'], config['min_seed'], config['max_seed'])
+            virtual = False
+        else:
+            dataset.v_src = rows = np.concatenate(epochs)
+            dataset.v_pool = np.full(len(rows), -1)
+            dataset.v_k = np.ones(len(rows), dtype=int)
+            dataset.v_seed = np.zeros(len(rows), dtype=int)
+            virtual = True
+        dataset.virtual = virtual
+        # the template of an epoch is the one of its (subject, label) in this dataset
+        dataset.erp_index = self.erp_index[rows]
+        dataset.epoch_nums = [len(y) for y in dataset.y]
+        dataset.y = np.concatenate(dataset.y).astype(np.int16)
+        dataset.data_shape = (len(dataset.y),) + self.X.shape[1:]
+        dataset.sbj_index = SubjectIndex(dataset.epoch_nums)
+        dataset.sbj_ids = dataset.sbj_index.sbj_ids
+        return dataset
         
-    def __up_sampling__(self, factor, min_seed, max_seed):
+    def __view_up_sampling__(self, epochs, factor, min_seed, max_seed):
+        """
+        Same class balancing as __up_sampling__ over the epochs of each subject of a view,
+        averaging the already scaled source epochs. Sets the epochs and labels of the view
+        and returns the source row of the (subject, label) of every new epoch.
+        """
+        X, rows = [], []
         for i in range(self.n_sbjs):
+            idxs = np.asarray(epochs[i])
             labels, weights = np.unique(self.y[i], return_counts=True)
-            X = [None]*len(weights)
-            y = [None]*len(weights)
-            original_L = len(self.X[i])
+            y = []
             for j in range(len(labels)):
-                X[j] = self.X[i][self.y[i] == labels[j]]
-                y[j] = self.y[i][self.y[i] == labels[j]]
+                members = idxs[self.y[i] == labels[j]]
                 # up-sampling for each class
-                new_X, new_y = sampling(X[j], y[j], factor*np.amax(weights), min_seed, max_seed)
-                self.X[i] = np.concatenate((self.X[i], new_X))
-                self.y[i] = np.concatenate((self.y[i], new_y))
+                new_X, new_y = sampling(self.X[members], self.y[i][self.y[i] == labels[j]], factor*np.amax(weights), min_seed, max_seed)
                 # add original data points for each class equally
-                idx = random.sample(range(weights[j]), np.amin(weights))
-                self.X[i] = np.concatenate((self.X[i], X[j][idx]))
-                self.y[i] = np.concatenate((self.y[i], y[j][idx]))
-                del new_X, new_y
-            # discard the original data to have noise balanced dataset
-            self.X[i] = self.X[i][original_L:]
-            self.y[i] = self.y[i][original_L:]
-            del X, y
-    
-    def __make_ERP_data__(self, raw_ERP, chn_idx_out):
-        ERP = []    
+                kept = members[random.sample(range(weights[j]), np.amin(weights))]
+                X += [new_X, self.X[kept]]
+                y += [new_y, np.full(len(kept), labels[j])]
+                rows += [np.full(len(new_X), members[0]), kept]
+            self.y[i] = np.concatenate(y)
+        self.X = np.concatenate(X)
+        return np.concatenate(rows)
+        
+    def __make_ERP_data__(self, raw_ERP, chn_idx_out, num_workers=1):
+        """
+        Returns the class-average ERP of every (subject, label) as a template table
+        (ntemplates, n_erp_chns, L) and the template index of every epoch.
+        Without raw_ERP the averages are computed over num_workers processes.
+        """
+        if raw_ERP is None:
+            raw_ERP = [None]*self.n_sbjs
+            jobs = [(i, shareArray(self.X[i]), self.y[i]) for i in range(self.n_sbjs)]
+            for job, erps in pool_imap(averageSubject, jobs, num_workers=num_workers):
+                raw_ERP[job[0]] = erps
+            del jobs
+        templates = []
+        erp_index = []
         for i in range(self.n_sbjs):
-            (nepochs, n_chns, L) = self.X[i].shape
             labels, weights = np.unique(self.y[i], return_counts=True)
-            erp = np.zeros((nepochs, len(chn_idx_out), L))
+            index = np.zeros(len(self.y[i]), dtype=np.int64)
             for j in range(len(labels)):
-                if (raw_ERP is not None):
-                    X_avg = raw_ERP[i][j][chn_idx_out]
-                else:
-                    X_avg = self.X[i][self.y[i] == labels[j]].mean(axis=0, keepdims=False)[chn_idx_out]
-                erp[self.y[i] == labels[j]] = X_avg
-            ERP.append(erp)
-        return ERP
+                X_avg = raw_ERP[i][j][chn_idx_out]
+                index[self.y[i] == labels[j]] = len(templates)
+                templates.append(X_avg)
+            erp_index.append(index)
+        return np.array(templates, dtype=np.float64), np.concatenate(erp_index)
+        
+def upSampleSubject(job, factor, min_seed, max_seed):
+    """
+    Up-sampled epochs and labels of one subject of ExperimentalERPDataset, job is
+    (subject, X, y, seed) with X shared by `shareArray`.
+    The global RNGs are seeded from the subject seed and restored afterwards.
+    """
+    (i, X, y, seed) = job
+    state = get_rng_state()
+    np.random.seed(seed)
+    random.seed(int(seed))
+    try:
+        return ExperimentalERPDataset.__up_sample_subject__(openSharedArray(X), y, factor, min_seed, max_seed)
+    finally:
+        set_rng_state(state)
+        
+def averageSubject(job):
+    """Class-average epochs (one per unique label) of one subject, job is (subject, X, y)."""
+    (i, X, y) = job
+    X = openSharedArray(X)
+    return np.array([X[y == label].mean(axis=0, keepdims=False) for label in np.unique(y)])
         
 class SimulatedERPDataset(ERPDataset):
     def __init__(self, config, loaded_data):
@@ -348,24 +676,26 @@ class SimulatedERPDataset(ERPDataset):
         self.X = loaded_data['X']
         self.y = loaded_data['y']
         self.n_sbjs = len(self.X)
-        if config['upsampling']:
-            self.__up_sampling__(config['factor'], config['min_seed'], config['max_seed'])
         raw_ERP = loaded_data['ERP'] if 'ERP' in loaded_data.keys() else None
-        self.ERP = self.__make_ERP_data__(config['latency_std'], config['min_w'], config['max_w'], sr, config['SNR'], raw_ERP, chn_idx_out, config['synthesized_type'])
+        # SNR may be a list, the dataset is built once and with_snr() selects a level.
+        SNRs = config['SNR'] if isinstance(config['SNR'], (list, tuple)) else [config['SNR']]
+        self.ERP, erp_adds, add_index, snr_mask = self.__make_ERP_data__(config, sr, raw_ERP, chn_idx_out)
         self.epoch_nums = []
         for i in range(self.n_sbjs):
             self.epoch_nums.append(len(self.y[i]))
-        X = 1e6*np.concatenate(self.X, axis=0)[...,self.start:self.end].astype(np.float32)
-        ERP = 1e6*np.concatenate(self.ERP, axis=0)[...,self.start:self.end].astype(np.float32)
+        # background epochs and the ERPs added to them are kept apart, at 0 dB.
+        X = concat_crop(self.X, None, None)
+        X_erp = concat_crop(erp_adds, None, None)
+        ERP = concat_crop(self.ERP, None, None)
         y = np.concatenate(self.y, axis=0).astype(np.int16)
+        add_offsets = np.cumsum([0] + [len(add) for add in erp_adds])
+        self.add_index = np.concatenate([np.where(index >= 0, index+offset, -1) for index, offset in zip(add_index, add_offsets)])
+        self.snr_mask = np.concatenate(snr_mask)
         scaler = None
         if config['scaler']['type'] is not None:
             path = os.path.expandvars(config['scaler']['path'])
-            data_shape = X.shape
-            X = X.reshape(-1, 1)
             if os.path.exists(path):
                 scaler = joblib.load(path)
-                X = scaler.transform(X)
             else:
                 if config['scaler']['type'] == 'MinMaxScaler':
                     feature_range = tuple(config['scaler']['feature_range'])
@@ -373,56 +703,86 @@ class SimulatedERPDataset(ERPDataset):
                     scaler = eval(config['scaler']['type'])(feature_range=feature_range)
                 elif config['scaler']['type'] == 'RobustScaler':
                     scaler = eval(config['scaler']['type'])(quantile_range=(5.0, 95.0))   
-                X = scaler.fit_transform(X)
+                # fitted on the epochs at the first SNR level, one subject at a time
+                self.__set_snr__(SNRs[0])
+                sbj_epochs = np.split(np.arange(len(X)), np.cumsum(self.epoch_nums)[:-1])
+                fitScaler(scaler, (self.__add_ERP__(X[idxs], idxs, X_erp) for idxs in sbj_epochs), factor=1e6)
                 joblib.dump(scaler, path)
-            X = X.reshape(data_shape)
-            ERP_shape = ERP.shape
-            ERP = scaler.transform(ERP.reshape(-1, 1)).reshape(ERP_shape)        
-        super().__init__(self.n_sbjs, X, y, ERP, channels_in, channels_erp, config['ERP_types'], sr, scaler)
+        value_range = scaleInplace(X, scaler, factor=1e6)
+        # the added ERPs and the targets only take the slope, the offset is in the backgrounds.
+        a, b = affine_params(scaler)
+        X_erp *= np.float32(1e6*a)
+        ERP *= np.float32(1e6*a)
+        self.X_erp = X_erp
+        self.ERP_bias = b
+        super().__init__(self.n_sbjs, X, y, ERP, channels_in, channels_erp, config['ERP_types'], sr, scaler, self.epoch_nums, value_range)
+        # min_value/max_value bound the fetched epochs, backgrounds plus the ERPs at the SNR.
+        self.bg_range = value_range
+        self.erp_range = (float(X_erp.min()), float(X_erp.max())) if len(X_erp) > 0 else (0.0, 0.0)
+        self.__set_snr__(SNRs[0])
         logger.info(f'self.epoch_nums: {self.epoch_nums}')        
         
+    def with_snr(self, snr):
+        """
+        Shallow copy sharing all epochs, with the target ERPs at snr dB.
+        """
+        dataset = copy.copy(self)
+        dataset.__set_snr__(snr)
+        return dataset
+        
+    def __set_snr__(self, snr):
+        # only the target ERPs follow the SNR, the non-target ones stay at 0 dB.
+        self.snr = snr
+        self.gains = np.where(self.snr_mask, np.sqrt(10**(snr/10)), 1).astype(np.float32)
+        if hasattr(self, 'bg_range'):
+            gains = (1.0, float(np.sqrt(10**(snr/10))))
+            self.min_value = self.bg_range[0] + min([0.0] + [g*self.erp_range[0] for g in gains])
+            self.max_value = self.bg_range[1] + max([0.0] + [g*self.erp_range[1] for g in gains])
+        
+    def __add_ERP__(self, X, idxs, X_erp=None):
+        X_erp = self.X_erp if X_erp is None else X_erp
+        rows = self.add_index[idxs]
+        has_erp = rows >= 0
+        X[has_erp] += self.gains[idxs[has_erp],None,None]*X_erp[rows[has_erp]]
+        return X
+        
+    def __get_X__(self, idx):
+        idxs = np.atleast_1d(idx)
+        X = self.__add_ERP__(self.X[idxs], idxs)
+        return X if np.ndim(idx) else X[0]
+        
     def __get_ERP__(self, idx):
-        return self.ERP[idx]
+        return np.asarray(self.gains[idx])[...,None,None]*self.ERP[idx] + self.ERP_bias
         
-    def __get_sbj_idx__(self, idx):
-        sum_ipochs = 0
-        for i in range(self.n_sbjs):
-            sum_ipochs += self.epoch_nums[i]
-            if sum_ipochs>idx:
-                sbj_idx = i
-                break
-        return sbj_idx  
+    @staticmethod
+    def __up_sampling__(X, y, factor, min_seed, max_seed):
+        # up-sampling for non-effect (class 0) only
+        labels = np.unique(y)
+        new_X, new_y = sampling(X[y == 0], y[y == 0], factor*len(labels)*int(np.sum(y == 0)), min_seed, max_seed)
+        return np.concatenate((X[y == 1], new_X)), np.concatenate((y[y == 1], new_y))
         
-    def __up_sampling__(self, factor, min_seed, max_seed):
-        for i in range(self.n_sbjs):
-            labels, weights = np.unique(self.y[i], return_counts=True)
-            # up-sampling for non-effect (class 0) only
-            X = self.X[i][self.y[i] == 0]
-            y = self.y[i][self.y[i] == 0]
-            new_X, new_y = sampling(X, y, factor*len(labels)*len(y), min_seed, max_seed)
-            self.X[i] = np.concatenate((self.X[i][self.y[i] == 1], new_X))
-            self.y[i] = np.concatenate((self.y[i][self.y[i] == 1], new_y))            
-            del X, y, new_X, new_y  
-
-    def __make_ERP_data__(self, latency_std, min_w, max_w, sr, SNR, raw_ERP, chn_idx_out, erp_type):
-        min_w = int(min_w*sr)
-        max_w = int(max_w*sr)
+    def __make_ERP_data__(self, config, sr, raw_ERP, chn_idx_out):
+        """
+        Simulates the subjects (up-sampling and ERP synthesis) over config['build_workers']
+        processes, see simulateSubject. Replaces self.X and self.y by the cropped background
+        epochs and labels and returns per subject the ERP targets, the ERPs to add, their
+        rows and the SNR masks.
+        The ERP latency of every subject and the grand average ERP are shared by all jobs.
+        """
+        latency_std = config['latency_std']
+        min_w = int(config['min_w']*sr)
+        max_w = int(config['max_w']*sr)
         min_ltc = int((MIN_LATENCY+PRE_STIMULUS)*sr)
         max_ltc = int((MAX_LATENCY+PRE_STIMULUS)*sr)
         nsbjs = len(self.X)
         latencies = [None]*nsbjs
         
         erps = []
-        non_erps = []
         for i in range(nsbjs):
             if raw_ERP is None:
-                non_erp = self.X[i][self.y[i] == 0].mean(axis=0, keepdims=False)
-                # labels, weights = np.unique(self.y[i], return_counts=True)
                 erp = self.X[i][self.y[i] == 1].mean(axis=0, keepdims=False)
             else:
-                non_erp = raw_ERP[i][0]
                 erp = raw_ERP[i][1]
-            non_erps.append(non_erp)
             erps.append(erp)
             (latency, amp) = mne.preprocessing.peak_finder(erp[chn_idx_out[0]])
             for ltc in latency:
@@ -440,67 +800,117 @@ class SimulatedERPDataset(ERPDataset):
         grand_w = findERPWidth(grand_erps[chn_idx_out[0]], min_w, max_w)
         logger.info(f'grand_ltc: {grand_ltc}')
         logger.info(f'grand_w: {grand_w}')
+        params = {'latencies': latencies, 'latency_std': latency_std, 'min_w': min_w, 'max_w': max_w, 'min_ltc': min_ltc, 'max_ltc': max_ltc,
+                  'sr': sr, 'grand_erps': grand_erps, 'grand_ltc': grand_ltc, 'grand_w': grand_w, 'chn_idx_out': chn_idx_out,
+                  'erp_type': config['synthesized_type'], 'crop': (self.start, self.end),
+                  'upsampling': (config['factor'], config['min_seed'], config['max_seed']) if config['upsampling'] else None}
+        # every subject is simulated from its own seed, drawn once from the global RNG,
+        # so the dataset does not depend on the number of workers.
+        seed = np.random.randint(2**31-1)
+        jobs = [(i, self.X[i], self.y[i], np.random.SeedSequence([seed, i]).generate_state(1)[0]) for i in range(nsbjs)]
+        num_workers = config['build_workers'] if 'build_workers' in config.keys() else 1
+        results = [None]*nsbjs
+        for job, result in pool_imap(simulateSubject, jobs, {'params': params}, num_workers):
+            results[job[0]] = result
+        (self.X, self.y, ERP, erp_adds, add_index, snr_mask) = [list(r) for r in zip(*results)]
+        del jobs, results
+        return ERP, erp_adds, add_index, snr_mask
         
-        # Sampling the mean and std for latency distribution of each subject
-        ltc_dist = grand_erps[chn_idx_out[0]][min_ltc:max_ltc]
-        ltc_dist = ((ltc_dist/np.sum(ltc_dist))*5000).astype(int)
-        ltc_array = []
-        ERP = []
-        for i in range(min_ltc, max_ltc):
-            ltc_array += [i for j in range(ltc_dist[i-min_ltc])]
-        for i in range(nsbjs):
-            non_target = self.X[i][self.y[i] == 0].mean(axis=0, keepdims=False)
-            (nepochs, n_chns, L) = self.X[i].shape
-            if latencies[i] is None:
-                logger.info(f'No ERP latency detected for subject {i}')
-                labels, weights = np.unique(self.y[i], return_counts=True)
-                erp = np.zeros((nepochs, len(chn_idx_out), L))
-                for j in range(len(labels)):
-                    X_avg = self.X[i][self.y[i] == labels[j]].mean(axis=0, keepdims=False)[chn_idx_out]
-                    erp[self.y[i] == labels[j]] = X_avg
-                ERP.append(erp)                
+def simulateSubject(job, params):
+    """
+    Simulated epochs of one subject of SimulatedERPDataset, job is (subject, X, y, seed).
+
+    Up-samples the background epochs (class 0) and returns the background epochs, labels,
+    ERP targets and the ERPs to add to the backgrounds (both at 0 dB), the row of its
+    added ERP for every epoch (-1 for none) and the mask of the target ERPs that follow
+    the SNR, cropped to params['crop'] in float32.
+    The global RNGs are seeded from the subject seed and restored afterwards.
+    """
+    (i, X, y, seed) = job
+    state = get_rng_state()
+    np.random.seed(seed)
+    random.seed(int(seed))
+    try:
+        if params['upsampling'] is not None:
+            X, y = SimulatedERPDataset.__up_sampling__(X, y, *params['upsampling'])
+        chn_idx_out = params['chn_idx_out']
+        sr = params['sr']
+        min_w, max_w = params['min_w'], params['max_w']
+        min_ltc, max_ltc = params['min_ltc'], params['max_ltc']
+        grand_erps, grand_ltc, grand_w = params['grand_erps'], params['grand_ltc'], params['grand_w']
+        latency = params['latencies'][i]
+        (nepochs, n_chns, L) = X.shape
+        if latency is None:
+            logger.info(f'No ERP latency detected for subject {i}')
+            labels, weights = np.unique(y, return_counts=True)
+            ERP_new = np.zeros((nepochs, len(chn_idx_out), L))
+            for j in range(len(labels)):
+                ERP_new[y == labels[j]] = X[y == labels[j]].mean(axis=0, keepdims=False)[chn_idx_out]
+            X_new = X
+            y_new = y
+            adds = np.zeros((0, n_chns, L), dtype=np.float32)
+            add_index = np.full(nepochs, -1)
+            snr_mask = np.zeros(nepochs, dtype=bool)
+        else:
+            # Add ERPs with latency in normal range as the target ERP (label 1s)
+            X_bg = X[y == 0]
+            idxs = np.arange(len(X_bg))
+            np.random.shuffle(idxs)
+            part1 = idxs[:int(len(idxs)/4)]
+            part2 = idxs[int(len(idxs)/4): int(len(idxs)/2)]
+            part3 = idxs[int(len(idxs)/2):]
+            ltc_high = latency + int(np.sqrt(3)*params['latency_std']*sr)
+            ltc_low = latency - int(np.sqrt(3)*params['latency_std']*sr)
+            ltcs = np.random.randint(ltc_low, ltc_high, len(part3))
+            widths = np.random.randint(min_w, max_w, len(part3))
+            if params['erp_type'] == 'sinusoid':
+                erp_target = makeSinERP(L, ltcs, widths, sr, grand_erps[:,grand_ltc])
             else:
-                # Add ERPs with latency in normal range as the target ERP (label 1s)
-                X_bg = self.X[i][self.y[i] == 0]
-                idxs = np.arange(len(X_bg))
-                np.random.shuffle(idxs)
-                part1 = idxs[:int(len(idxs)/4)]
-                part2 = idxs[int(len(idxs)/4): int(len(idxs)/2)]
-                part3 = idxs[int(len(idxs)/2):]
-                X_new = X_bg[part1]
-                y_new = np.zeros(len(X_new))
-                ERP_new = np.zeros((X_new.shape[0], len(chn_idx_out), X_new.shape[2]))
-                # X_bg = X_bg[:60]
-                ltc_high = latencies[i] + int(np.sqrt(3)*latency_std*sr)
-                ltc_low = latencies[i] - int(np.sqrt(3)*latency_std*sr)
-                ltcs = np.random.randint(ltc_low, ltc_high, len(part3))
-                widths = np.random.randint(min_w, max_w, len(part3))
-                if erp_type == 'sinusoid':
-                    erp = makeSinERP(L, ltcs, widths, sr, grand_erps[:,grand_ltc], snr=SNR)
-                else:
-                    erp = makeRealERP(L, ltcs, widths, sr, grand_erps, grand_ltc, grand_w, snr=SNR)
-                X_new = np.concatenate((X_new, X_bg[part3]+erp))
-                y_new = np.concatenate((y_new, np.ones(len(erp))))
-                ERP_new = np.concatenate((ERP_new, erp[:,chn_idx_out,:]))           
-                # Add ERPs with latency out normal range as the non-target ERP (label 0)
-                ltcs = np.random.randint(-max_w, min_ltc, int(len(part2)/2))
-                ltcs = np.concatenate((ltcs, np.random.randint(max_ltc, L+max_w, len(part2)-int(len(part2)/2))))
-                widths = np.random.randint(min_w, max_w, len(ltcs))
-                if erp_type == 'sinusoid':
-                    erp = makeSinERP(L, ltcs, widths, sr, grand_erps[:,grand_ltc])
-                else:
-                    erp = makeRealERP(L, ltcs, widths, sr, grand_erps, grand_ltc, grand_w)
-                X_new = np.concatenate((X_new, X_bg[part2]+erp))
-                y_new = np.concatenate((y_new, np.zeros(len(erp))))
-                ERP_new = np.concatenate((ERP_new, erp[:,chn_idx_out,:]))
-                self.X[i] = X_new
-                self.y[i] = y_new
-                ERP.append(ERP_new)
-                del X_new, y_new, ERP_new
-        ERP = np.array(ERP, dtype=object)       
-        return ERP            
+                erp_target = makeRealERP(L, ltcs, widths, sr, grand_erps, grand_ltc, grand_w)
+            # Add ERPs with latency out normal range as the non-target ERP (label 0)
+            ltcs = np.random.randint(-max_w, min_ltc, int(len(part2)/2))
+            ltcs = np.concatenate((ltcs, np.random.randint(max_ltc, L+max_w, len(part2)-int(len(part2)/2))))
+            widths = np.random.randint(min_w, max_w, len(ltcs))
+            if params['erp_type'] == 'sinusoid':
+                erp_non_target = makeSinERP(L, ltcs, widths, sr, grand_erps[:,grand_ltc])
+            else:
+                erp_non_target = makeRealERP(L, ltcs, widths, sr, grand_erps, grand_ltc, grand_w)
+            X_new = np.concatenate((X_bg[part1], X_bg[part3], X_bg[part2]))
+            y_new = np.concatenate((np.zeros(len(part1)), np.ones(len(part3)), np.zeros(len(part2))))
+            ERP_new = np.concatenate((np.zeros((len(part1), len(chn_idx_out), L)), erp_target[:,chn_idx_out,:], erp_non_target[:,chn_idx_out,:]))
+            adds = np.concatenate((erp_target, erp_non_target))
+            add_index = np.concatenate((np.full(len(part1), -1), np.arange(len(part3)+len(part2))))
+            snr_mask = np.concatenate((np.zeros(len(part1), dtype=bool), np.ones(len(part3), dtype=bool), np.zeros(len(part2), dtype=bool)))
+    finally:
+        set_rng_state(state)
+    start, end = params['crop']
+    return (concat_crop([X_new], start, end), y_new, concat_crop([ERP_new], start, end), concat_crop([adds], start, end), add_index, snr_mask)
         
 class MixedERPDataset(ConcatDataset):
     def __init__(self, datasets, scaler):
         self.scaler = scaler       
-        super().__init__(datasets)
\ No newline at end of file
+        super().__init__(datasets)
+        
+    def __getitems__(self, idxs):
+        # batch fetch from every sub-dataset, then restore the requested order.
+        idxs = np.asarray(idxs, dtype=np.int64)
+        ds_idxs = np.searchsorted(self.cumulative_sizes, idxs, side='right')
+        offsets = np.concatenate(([0], self.cumulative_sizes[:-1]))
+        batches = []
+        order = []
+        for d in np.unique(ds_idxs):
+            selected = np.nonzero(ds_idxs == d)[0]
+            batches.append(self.datasets[d].__getitems__(idxs[selected] - offsets[d]))
+            order.append(selected)
+        inverse = torch.from_numpy(np.argsort(np.concatenate(order)))
+        return tuple(torch.cat(items)[inverse] for items in zip(*batches))
+        
+def collate_batch(batch):
+    # batches are already stacked by __getitems__.
+    return batch
+    
+def makeDataLoader(dataset, batch_size=1, shuffle=False, sampler=None, num_workers=0, pin_memory=False, drop_last=False):
+    """DataLoader fetching whole batches through the `__getitems__` of ERP datasets."""
+    if sampler is None:
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=num_workers, pin_memory=pin_memory, drop_last=drop_last, collate_fn=collate_batch)
\ No newline at end of file
@@ -0,0 +1,204 @@
+import numpy as np
+from utils import logging
+logger = logging.getLogger()
+
+def iter_chunks(X, chunk_size=4096):
+    """Iterate over row chunks of a lag matrix.
+
+    Arguments
+    ---------
+    X : array (num frames, num features) or list of per-trial LagMatrix/arrays, rows are
+        numbered as if the list was concatenated.
+    chunk_size : scalar, number of rows materialized at once.
+
+    Yields
+    ------
+    (start, X_chunk) : first row of the chunk and the (rows, num features) chunk.
+    """
+    if not isinstance(X, list):
+        X = [X]
+    offset = 0
+    for trial in X:
+        n = len(trial)
+        for start in range(0, n, chunk_size):
+            yield offset + start, np.asarray(trial[start:start+chunk_size])
+        offset += n
+
+class RidgeStats:
+    """Sufficient statistics (X'X, X'y, sums and counts) of a ridge regression.
+
+    The statistics are kept separately for each cross-validation fold, so that the
+    statistics of any training split are sums/differences of them.
+    """
+    def __init__(self, n_features, n_targets, n_folds=5):
+        self.n = np.zeros(n_folds)
+        self.sx = np.zeros((n_folds, n_features))
+        self.sy = np.zeros((n_folds, n_targets))
+        self.sxx = np.zeros((n_folds, n_features, n_features))
+        self.sxy = np.zeros((n_folds, n_features, n_targets))
+        self.syy = np.zeros((n_folds, n_targets))
+
+    @property
+    def n_folds(self):
+        return len(self.n)
+
+    def update(self, X, y, folds):
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64).reshape(len(X), -1)
+        for k in range(self.n_folds):
+            mask = (folds==k)
+            Xk = X[mask]
+            yk = y[mask]
+            self.n[k] += len(Xk)
+            self.sx[k] += Xk.sum(axis=0)
+            self.sy[k] += yk.sum(axis=0)
+            self.sxx[k] += Xk.T @ Xk
+            self.sxy[k] += Xk.T @ yk
+            self.syy[k] += (yk**2).sum(axis=0)
+
+    def fold(self, k):
+        """Statistics of fold k only."""
+        return self.__select__(lambda value: value[k:k+1])
+
+    def exclude(self, k):
+        """Statistics of all folds but k."""
+        return self.__select__(lambda value: np.delete(value, k, axis=0))
+
+    def __select__(self, func):
+        stats = RidgeStats.__new__(RidgeStats)
+        for key, value in vars(self).items():
+            setattr(stats, key, func(value))
+        return stats
+
+    def __add__(self, other):
+        if other == 0: # allows sum() over a list of stats
+            return self
+        return self.__select__(lambda value: value.copy()).__iadd__(other)
+
+    __radd__ = __add__
+
+    def __iadd__(self, other):
+        for key, value in vars(self).items():
+            value += getattr(other, key)
+        return self
+
+    def __sub__(self, other):
+        stats = self.__select__(lambda value: value.copy())
+        for key, value in vars(stats).items():
+            value -= getattr(other, key)
+        return stats
+
+    def save(self, path):
+        np.savez(path, **vars(self))
+
+    @staticmethod
+    def load(path):
+        stats = RidgeStats.__new__(RidgeStats)
+        with np.load(path) as data:
+            for key in data.files:
+                setattr(stats, key, data[key])
+        return stats
+
+    def centered(self):
+        """Return (n, mean_x, mean_y, Cxx, Cxy) pooled over all folds."""
+        n = self.n.sum()
+        mx = self.sx.sum(axis=0)/n
+        my = self.sy.sum(axis=0)/n
+        Cxx = self.sxx.sum(axis=0) - n*np.outer(mx, mx)
+        Cxy = self.sxy.sum(axis=0) - n*np.outer(mx, my)
+        return n, mx, my, Cxx, Cxy
+
+def accumulate_stats(X, y, n_folds=5, random_state=0, chunk_size=4096):
+    """Stream X (see iter_chunks) and y into RidgeStats with random fold assignment."""
+    model = StreamingRidge(alphas=(), n_folds=n_folds, random_state=random_state)
+    for start, X_chunk in iter_chunks(X, chunk_size):
+        model.partial_fit(X_chunk, y[start:start+len(X_chunk)])
+    return model.stats
+
+def ridge_path(stats, alphas):
+    """Solve the ridge problem of stats for all alphas from one eigendecomposition.
+
+    Returns
+    -------
+    coefs : array, (num alphas, num features, num targets)
+    intercepts : array, (num alphas, num targets)
+    """
+    n, mx, my, Cxx, Cxy = stats.centered()
+    s, V = np.linalg.eigh(Cxx)
+    Q = V.T @ Cxy
+    coefs = np.stack([V @ (Q/(s+alpha)[:,None]) for alpha in alphas])
+    intercepts = my[None,:] - np.einsum('f,aft->at', mx, coefs)
+    return coefs, intercepts
+
+def pearson_from_stats(stats, coef, intercept):
+    """Pearson correlation between y and X@coef+intercept over the samples of stats.
+
+    Targets are pooled like `pearson_scorer` does with raveled arrays.
+    """
+    n = stats.n.sum()
+    sx = stats.sx.sum(axis=0)
+    sxx = stats.sxx.sum(axis=0)
+    sxy = stats.sxy.sum(axis=0)
+    N = n*len(intercept)
+    s_y = stats.sy.sum()
+    s_yy = stats.syy.sum()
+    s_p = (sx @ coef).sum() + n*intercept.sum()
+    s_pp = np.einsum('ft,fg,gt->', coef, sxx, coef) + 2*(intercept*(sx @ coef)).sum() + n*(intercept**2).sum()
+    s_py = np.einsum('ft,ft->', coef, sxy) + (intercept*stats.sy.sum(axis=0)).sum()
+    cov = N*s_py - s_p*s_y
+    var = (N*s_pp - s_p**2)*(N*s_yy - s_y**2)
+    return cov/np.sqrt(var) if var > 0 else 0.0
+
+class StreamingRidge:
+    """Out-of-core replacement of `RidgeCV(scoring=pearson_scorer, cv=KFold(shuffle=True))`.
+
+    Samples are streamed through `partial_fit` and only X'X/X'y of each CV fold are
+    accumulated. `solve` picks the alpha with the best mean held-out Pearson
+    correlation and refits on all samples, each from a single eigendecomposition.
+    """
+    def __init__(self, alphas, n_folds=5, random_state=0):
+        self.alphas = np.asarray(alphas, dtype=float)
+        self.n_folds = n_folds
+        self.rng = np.random.default_rng(random_state)
+        self.stats = None
+        self.alpha_ = None
+        self.coef_ = None
+        self.intercept_ = None
+
+    def partial_fit(self, X, y):
+        y = np.asarray(y).reshape(len(X), -1)
+        if self.stats is None:
+            self.stats = RidgeStats(X.shape[-1], y.shape[-1], self.n_folds)
+        folds = self.rng.integers(self.n_folds, size=len(X))
+        self.stats.update(X, y, folds)
+        return self
+
+    def fit(self, X, y, chunk_size=4096):
+        for start, X_chunk in iter_chunks(X, chunk_size):
+            self.partial_fit(X_chunk, y[start:start+len(X_chunk)])
+        return self.solve()
+
+    def solve(self, stats=None):
+        if stats is not None:
+            self.stats = stats
+        stats = self.stats
+        scores = np.zeros((stats.n_folds, len(self.alphas)))
+        for k in range(stats.n_folds):
+            coefs, intercepts = ridge_path(stats.exclude(k), self.alphas)
+            test = stats.fold(k)
+            for a in range(len(self.alphas)):
+                scores[k, a] = pearson_from_stats(test, coefs[a], intercepts[a])
+        self.cv_scores_ = scores.mean(axis=0)
+        best = int(np.argmax(self.cv_scores_))
+        self.alpha_ = self.alphas[best]
+        coefs, intercepts = ridge_path(stats, self.alphas[best:best+1])
+        self.coef_ = coefs[0]
+        self.intercept_ = intercepts[0]
+        logger.info(f'ridge alpha: {self.alpha_}, cv pearson: {self.cv_scores_[best]:.4f}')
+        return self
+
+    def predict(self, X, chunk_size=4096):
+        if isinstance(X, np.ndarray):
+            return X @ self.coef_ + self.intercept_
+        pred = [X_chunk @ self.coef_ + self.intercept_ for _, X_chunk in iter_chunks(X, chunk_size)]
+        return np.concatenate(pred, axis=0)
@@ -0,0 +1,184 @@
+import numpy as np
+from scipy.stats import norm
+from sklearn.preprocessing import MinMaxScaler, RobustScaler
+from utils import logging
+logger = logging.getLogger()
+
+def affine_params(scaler):
+    """Return (a, b) with `scaler.transform(x) == a*x + b` for a scaler fitted on one feature.
+
+    The scalers used for EEG amplitudes are affine, so ERPs added to already scaled
+    epochs only need the slope `a`.
+    """
+    if scaler is None:
+        return 1.0, 0.0
+    if isinstance(scaler, RobustScaler):
+        scale = float(scaler.scale_[0]) if scaler.with_scaling else 1.0
+        center = float(scaler.center_[0]) if scaler.with_centering else 0.0
+        return 1.0/scale, -center/scale
+    if isinstance(scaler, MinMaxScaler):
+        return float(scaler.scale_[0]), float(scaler.min_[0])
+    raise ValueError(f'unsupported scaler: {type(scaler).__name__}')
+
+def _add_bins(bins, offset, keys):
+    """Add the keys into a dense count array whose first bin is key `offset`."""
+    if len(keys) == 0:
+        return bins, offset
+    low = int(keys.min()) if bins is None else min(offset, int(keys.min()))
+    high = int(keys.max()) if bins is None else max(offset+len(bins)-1, int(keys.max()))
+    counts = np.bincount(keys-low, minlength=high-low+1).astype(np.int64)
+    if bins is not None:
+        counts[offset-low:offset-low+len(bins)] += bins
+    return counts, low
+
+def _merge_bins(bins, offset, other, other_offset):
+    """Sum two dense count arrays whose first bins are the keys offset and other_offset."""
+    if other is None:
+        return bins, offset
+    if bins is None:
+        return other.copy(), other_offset
+    low = min(offset, other_offset)
+    high = max(offset+len(bins), other_offset+len(other))
+    counts = np.zeros(high-low, dtype=np.int64)
+    counts[offset-low:offset-low+len(bins)] += bins
+    counts[other_offset-low:other_offset-low+len(other)] += other
+    return counts, low
+
+class QuantileSketch:
+    """Mergeable quantile sketch with bounded relative error (logarithmic buckets).
+
+    Values are counted in buckets `(gamma**(k-1), gamma**k]` of their magnitude, with
+    `gamma = (1+relative_accuracy)/(1-relative_accuracy)`, so any quantile is returned
+    within `relative_accuracy*|value|` of the exact one. Values smaller than `min_value`
+    in magnitude are counted as zeros. Sketches of different subjects/files are merged
+    with `+=`, min/max are exact.
+    """
+    def __init__(self, relative_accuracy=1e-3, min_value=1e-6):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1+relative_accuracy)/(1-relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.pos, self.pos_offset = None, 0
+        self.neg, self.neg_offset = None, 0
+        self.zeros = 0
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def __keys__(self, x):
+        return np.ceil(np.log(x)/self.log_gamma).astype(np.int64)
+
+    def update(self, x):
+        x = np.asarray(x).ravel()
+        x = x[~np.isnan(x)]
+        if len(x) == 0:
+            return self
+        self.count += len(x)
+        self.min = min(self.min, float(x.min()))
+        self.max = max(self.max, float(x.max()))
+        pos = x[x >= self.min_value]
+        neg = -x[x <= -self.min_value]
+        self.zeros += len(x) - len(pos) - len(neg)
+        self.pos, self.pos_offset = _add_bins(self.pos, self.pos_offset, self.__keys__(pos))
+        self.neg, self.neg_offset = _add_bins(self.neg, self.neg_offset, self.__keys__(neg))
+        return self
+
+    def __iadd__(self, other):
+        self.pos, self.pos_offset = _merge_bins(self.pos, self.pos_offset, other.pos, other.pos_offset)
+        self.neg, self.neg_offset = _merge_bins(self.neg, self.neg_offset, other.neg, other.neg_offset)
+        self.zeros += other.zeros
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, q):
+        """Value at quantile q (0 <= q <= 1), ranks as in `np.percentile`."""
+        values = [np.zeros(1)]
+        counts = [np.array([self.zeros])]
+        # bucket value with the smallest relative error to all its members
+        if self.neg is not None:
+            values.insert(0, -2*self.gamma**(np.arange(len(self.neg)) + self.neg_offset)[::-1]/(self.gamma+1))
+            counts.insert(0, self.neg[::-1])
+        if self.pos is not None:
+            values.append(2*self.gamma**(np.arange(len(self.pos)) + self.pos_offset)/(self.gamma+1))
+            counts.append(self.pos)
+        values = np.concatenate(values)
+        cum_counts = np.cumsum(np.concatenate(counts))
+        rank = q*(self.count-1)
+        value = values[np.searchsorted(cum_counts, rank, side='right')]
+        return float(np.clip(value, self.min, self.max))
+
+def _handle_zero_scale(scale):
+    return 1.0 if scale < 10*np.finfo(np.float64).eps else scale
+
+def fitScaler(scaler, data, factor=1.0, chunk_size=1<<20, relative_accuracy=1e-3):
+    """Fit a RobustScaler/MinMaxScaler on all values of data in one streaming pass.
+
+    Arguments
+    ---------
+    scaler : unfitted sklearn RobustScaler or MinMaxScaler, fitted in place as if it was
+        fitted on the concatenated `factor*data` reshaped to (-1, 1).
+    data : iterable of arrays (e.g. per-subject epochs, memmaps are read chunk by chunk).
+    factor : scalar, applied to each chunk (1e6 for EEG in volts).
+    chunk_size : scalar, number of values converted at once.
+    relative_accuracy : scalar, relative error bound of the RobustScaler quantiles.
+
+    The result is a plain sklearn scaler that is stored with joblib as before.
+    """
+    # one sketch per item of data, merged into the total one.
+    sketch = QuantileSketch(relative_accuracy)
+    for X in data:
+        X = np.asarray(X).reshape(-1)
+        item = QuantileSketch(relative_accuracy)
+        for start in range(0, len(X), chunk_size):
+            item.update(factor*X[start:start+chunk_size].astype(np.float64))
+        sketch += item
+    scaler.n_features_in_ = 1
+    if isinstance(scaler, RobustScaler):
+        q_min, q_max = scaler.quantile_range
+        scaler.center_ = np.array([sketch.quantile(0.5)]) if scaler.with_centering else None
+        if scaler.with_scaling:
+            scale = _handle_zero_scale(sketch.quantile(q_max/100) - sketch.quantile(q_min/100))
+            if scaler.unit_variance:
+                scale /= norm.ppf(q_max/100) - norm.ppf(q_min/100)
+            scaler.scale_ = np.array([scale])
+        else:
+            scaler.scale_ = None
+    elif isinstance(scaler, MinMaxScaler):
+        low, high = scaler.feature_range
+        scaler.n_samples_seen_ = sketch.count
+        scaler.data_min_ = np.array([sketch.min])
+        scaler.data_max_ = np.array([sketch.max])
+        scaler.data_range_ = scaler.data_max_ - scaler.data_min_
+        scaler.scale_ = (high - low)/np.array([_handle_zero_scale(scaler.data_range_[0])])
+        scaler.min_ = low - scaler.data_min_*scaler.scale_
+    else:
+        raise ValueError(f'unsupported scaler: {type(scaler).__name__}')
+    logger.info(f'fitted {type(scaler).__name__} on {sketch.count} values')
+    return scaler
+
+def scaleInplace(X, scaler=None, factor=1.0, chunk_size=1<<20):
+    """Apply `scaler.transform(factor*X)` in place, chunk by chunk in the dtype of X.
+
+    Replaces `scaler.transform(X.reshape(-1, 1))`, which upcasts to float64 and
+    allocates the output, and collects the value range in the same pass.
+
+    Returns
+    -------
+    (min, max) : value range of the scaled X.
+    """
+    a, b = affine_params(scaler)
+    a = np.asarray(a*factor, dtype=X.dtype)
+    b = np.asarray(b, dtype=X.dtype)
+    flat = X.reshape(-1)
+    if not np.shares_memory(flat, X):
+        raise ValueError('X must be contiguous to be scaled in place')
+    low, high = np.inf, -np.inf
+    for start in range(0, len(flat), chunk_size):
+        chunk = flat[start:start+chunk_size]
+        chunk *= a
+        chunk += b
+        low = min(low, chunk.min())
+        high = max(high, chunk.max())
+    return low, high
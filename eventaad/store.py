@@ -0,0 +1,184 @@
+import os
+import numpy as np
+from scipy.io import loadmat
+from utils import logging
+logger = logging.getLogger()
+
+STORE_EXT = '.store'
+EPOCHS_FILE = 'epochs.f32'
+INDEX_FILE = 'index.npz'
+TRIAL_FIELDS = ('eeg', 'audio', 'attdEvent', 'unAttdEvent')
+
+def getStorePath(ds_path):
+    """Return the epoch store folder that belongs to a raw `.npz` dataset."""
+    return os.path.splitext(ds_path)[0] + STORE_EXT
+
+def source_fingerprint(path):
+    st = os.stat(path)
+    return np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+def shareArray(X):
+    """Return (filename, offset, dtype, shape) of X when it is a contiguous slice of a file
+    memmap, so that another process can reopen it with `openSharedArray`, else X itself."""
+    root = X
+    while isinstance(root, np.ndarray) and isinstance(root.base, np.ndarray):
+        root = root.base
+    if not (isinstance(root, np.memmap) and root.filename is not None and X.flags.c_contiguous):
+        return X
+    offset = root.offset + X.ctypes.data - root.ctypes.data
+    return (root.filename, offset, X.dtype.str, X.shape)
+
+def openSharedArray(shared):
+    """Read-only memmap of an array shared by `shareArray`, arrays are returned as is."""
+    if isinstance(shared, np.ndarray):
+        return shared
+    filename, offset, dtype, shape = shared
+    return np.memmap(filename, dtype=np.dtype(dtype), mode='r', offset=offset, shape=shape)
+
+def isStoreValid(ds_path, store_path, data_files=(EPOCHS_FILE,)):
+    index_path = os.path.join(store_path, INDEX_FILE)
+    if not (os.path.exists(index_path) and all(os.path.exists(os.path.join(store_path, f)) for f in data_files)):
+        return False
+    if not os.path.exists(ds_path):
+        # only the converted store was shipped, trust it.
+        return True
+    with np.load(index_path) as index:
+        return np.array_equal(index['source'], source_fingerprint(ds_path))
+
+def convertERPdata(ds_path, store_path=None):
+    """Convert an object-array `.npz` dataset into a flat float32 epoch store.
+
+    Arguments
+    ---------
+    ds_path : str, raw dataset with per-subject object arrays `X` (nepochs, chns, L) and `y`.
+    store_path : str, output folder, defaults to `getStorePath(ds_path)`.
+
+    The store holds all epochs of all subjects contiguously in `epochs.f32` and an
+    `index.npz` with the per-subject offsets, the flat labels and the class-average
+    ERPs (one row per unique label of each subject), plus the remaining metadata
+    fields of the source file (channels, ...).
+    """
+    if store_path is None:
+        store_path = getStorePath(ds_path)
+    logger.info(f'converting raw dataset {ds_path} into epoch store {store_path}')
+    os.makedirs(store_path, exist_ok=True)
+    loaded_data = np.load(ds_path, allow_pickle=True)
+    X_raw = loaded_data['X']
+    y_raw = loaded_data['y']
+    nsbjs = len(X_raw)
+    epoch_shape = X_raw[0].shape[1:]
+    offsets = np.zeros(nsbjs+1, dtype=np.int64)
+    for i in range(nsbjs):
+        offsets[i+1] = offsets[i] + len(X_raw[i])
+    epochs = np.memmap(os.path.join(store_path, EPOCHS_FILE), dtype=np.float32, mode='w+', shape=(offsets[-1],)+epoch_shape)
+    ERP = []
+    ERP_labels = []
+    erp_offsets = np.zeros(nsbjs+1, dtype=np.int64)
+    for i in range(nsbjs):
+        epochs[offsets[i]:offsets[i+1]] = X_raw[i]
+        labels = np.unique(y_raw[i])
+        for j in range(len(labels)):
+            ERP.append(X_raw[i][y_raw[i] == labels[j]].mean(axis=0, keepdims=False))
+        ERP_labels.append(labels)
+        erp_offsets[i+1] = erp_offsets[i] + len(labels)
+    epochs.flush()
+    del epochs
+    metadata = {k: loaded_data[k] for k in loaded_data.files if k not in ('X', 'y')}
+    np.savez(os.path.join(store_path, INDEX_FILE),
+             shape=np.array((offsets[-1],)+epoch_shape, dtype=np.int64),
+             offsets=offsets,
+             y=np.concatenate([np.asarray(y) for y in y_raw]),
+             ERP=np.array(ERP, dtype=np.float32),
+             ERP_labels=np.concatenate(ERP_labels),
+             erp_offsets=erp_offsets,
+             source=source_fingerprint(ds_path),
+             metadata_keys=np.array(list(metadata.keys()), dtype=str),
+             **{f'metadata_{k}': v for k, v in metadata.items()})
+    del loaded_data, X_raw, y_raw
+    return store_path
+
+def loadERPstore(store_path):
+    """Open an epoch store created by `convertERPdata`.
+
+    Returns the same dictionary layout as `makeERPdata` where `X[i]` is a zero-copy,
+    read-only memmap slice of subject i and `ERP[i]` holds its class-average ERPs.
+    """
+    logger.info(f'opening epoch store {store_path}')
+    with np.load(os.path.join(store_path, INDEX_FILE), allow_pickle=True) as index:
+        shape = tuple(index['shape'])
+        offsets = index['offsets']
+        y = index['y']
+        ERP = index['ERP']
+        erp_offsets = index['erp_offsets']
+        loaded_data = {str(k): index[f'metadata_{k}'] for k in index['metadata_keys']}
+    epochs = np.memmap(os.path.join(store_path, EPOCHS_FILE), dtype=np.float32, mode='r', shape=shape)
+    nsbjs = len(offsets) - 1
+    loaded_data['X'] = [epochs[offsets[i]:offsets[i+1]] for i in range(nsbjs)]
+    loaded_data['y'] = [y[offsets[i]:offsets[i+1]] for i in range(nsbjs)]
+    loaded_data['ERP'] = [ERP[erp_offsets[i]:erp_offsets[i+1]] for i in range(nsbjs)]
+    loaded_data['store'] = store_path
+    return loaded_data
+
+def getTrialFiles():
+    return tuple(f'{field}.bin' for field in TRIAL_FIELDS)
+
+def convertMATdata(mat_path, store_path=None):
+    """Convert a preprocessed `.mat` subject into a flat, memory-mappable trial store.
+
+    Arguments
+    ---------
+    mat_path : str, MATLAB file with per-trial `eeg`, `audio`, `attdEvent`, `unAttdEvent`
+        cells, the `attdSpeaker` vector, `sr` and `channels`.
+    store_path : str, output folder, defaults to `getStorePath(mat_path)`.
+
+    The trials of each per-trial field are concatenated along time into `<field>.bin`
+    (source dtype kept), with the per-trial offsets in `index.npz`.
+    """
+    if store_path is None:
+        store_path = getStorePath(mat_path)
+    logger.info(f'converting {mat_path} into trial store {store_path}')
+    os.makedirs(store_path, exist_ok=True)
+    loaded_data = loadmat(mat_path, squeeze_me=True)
+    index = {}
+    for field in TRIAL_FIELDS:
+        trials = loaded_data[field]
+        trials = list(trials) if trials.dtype == object else [trials]
+        trials = [np.atleast_1d(trial) for trial in trials]
+        offsets = np.cumsum([0] + [len(trial) for trial in trials]).astype(np.int64)
+        flat = np.concatenate(trials, axis=0)
+        data = np.memmap(os.path.join(store_path, f'{field}.bin'), dtype=flat.dtype, mode='w+', shape=flat.shape)
+        data[:] = flat
+        data.flush()
+        index[f'{field}_offsets'] = offsets
+        # the layout of the written file, concatenation may upcast mixed trial dtypes.
+        index[f'{field}_shape'] = np.array(flat.shape[1:], dtype=np.int64)
+        index[f'{field}_dtype'] = np.array(flat.dtype.str)
+        del data, flat
+    np.savez(os.path.join(store_path, INDEX_FILE),
+             source=source_fingerprint(mat_path),
+             attdSpeaker=np.atleast_1d(loaded_data['attdSpeaker']),
+             sr=np.array(loaded_data['sr']),
+             channels=np.array(loaded_data['channels'], dtype=str),
+             **index)
+    del loaded_data
+    return store_path
+
+def loadMATstore(store_path):
+    """Open a trial store created by `convertMATdata`.
+
+    Returns the fields of `loadmat(mat_path, squeeze_me=True)` used by the linear
+    pipeline, per-trial fields are lists of read-only memmap slices.
+    """
+    with np.load(os.path.join(store_path, INDEX_FILE)) as index:
+        loaded_data = {
+            'attdSpeaker': index['attdSpeaker'],
+            'sr': index['sr'].item(),
+            'channels': index['channels'],
+        }
+        for field in TRIAL_FIELDS:
+            offsets = index[f'{field}_offsets']
+            shape = (int(offsets[-1]),) + tuple(index[f'{field}_shape'])
+            data = np.memmap(os.path.join(store_path, f'{field}.bin'), dtype=np.dtype(str(index[f'{field}_dtype'])), mode='r', shape=shape)
+            loaded_data[field] = [data[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1)]
+    loaded_data['store'] = store_path
+    return loaded_data
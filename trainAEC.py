@@ -12,6 +12,8 @@ from torch.optim.lr_scheduler import StepLR
 from eventaad.AEC import *
 from eventaad.EEGModels import *
 from eventaad.dataset import *
+from eventaad.scaler import fitScaler
+from eventaad.cache import seed_rng, getSeed
 import eventaad.loss as L
 from eventaad.loss import *
 from utils.parallel import *
@@ -30,6 +32,8 @@ def trainSubjecIndependent(config, jobname):
     os.makedirs(output_path, exist_ok=True)
     
     dataset_params = config['dataset']
+    if getSeed(dataset_params) is not None:
+        seed_rng(getSeed(dataset_params))
     data_folder = os.path.expandvars(dataset_params['folder'])
     data_files = dataset_params['pre_processed']
     upsampling = dataset_params['upsampling']
@@ -80,31 +84,22 @@ def trainSubjecIndependent(config, jobname):
     separated_accs = np.zeros((2, 15, nFold))
     separated_F1 = np.zeros((2, 15, nFold))
     if type(data_files) is list:
-        loaded_data = []
-        for f in data_files:
-            path = os.path.join(data_folder, f)
-            loaded_data.append(makeERPdata(path))
+        build_workers = dataset_params['build_workers'] if 'build_workers' in dataset_params else 1
+        loaded_data = makeERPdatasets([os.path.join(data_folder, f) for f in data_files], build_workers)
         if dataset_params['scaler']['type'] is not None:
             scaler_path = os.path.expandvars(dataset_params['scaler']['path'])
             if os.path.exists(scaler_path):
                 scaler = joblib.load(scaler_path)
             else:
-                X = []
-                for data in loaded_data:
-                    new_X = np.concatenate(data['X'])
-                    X.append(new_X)
-                X = 1e6*np.concatenate(X)
-                data_shape = X.shape
-                logger.info(f'Raw data shape: {data_shape}')
-                X = X.reshape(-1, 1)
+                logger.info(f'Raw data epochs: {sum(len(X) for data in loaded_data for X in data["X"])}')
                 if dataset_params['scaler']['type'] == 'MinMaxScaler':
                     feature_range = tuple(dataset_params['scaler']['feature_range'])
                     scaler = eval(dataset_params['scaler']['type'])(feature_range=feature_range)
                 else:
                     scaler = RobustScaler(quantile_range=(5.0, 95.0))   
-                scaler.fit_transform(X)
-                joblib.dump(scaler, scaler_path)                
-                del X
+                # one streaming pass over the subjects instead of a concatenated copy
+                fitScaler(scaler, [X for data in loaded_data for X in data['X']], factor=1e6)
+                joblib.dump(scaler, scaler_path)
                 
     else:
         path = os.path.join(data_folder, data_files)
@@ -133,9 +128,9 @@ def trainSubjecIndependent(config, jobname):
                 trainset, validset, testset = get_splited_datasets(fold, loaded_data, splits, dataset_params)
             
             # dataloader
-            trainLoader = DataLoader(dataset=trainset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
-            validLoader = DataLoader(dataset=validset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
-            testLoader = DataLoader(dataset=testset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)       
+            trainLoader = makeDataLoader(dataset=trainset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
+            validLoader = makeDataLoader(dataset=validset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
+            testLoader = makeDataLoader(dataset=testset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)       
             model_path = os.path.join(output_path, f"{model_params['model_name']}_SI_fold_{fold}.pth")
 
             # model
@@ -162,20 +157,10 @@ def trainSubjecIndependent(config, jobname):
             train_loss, train_accs[fold], train_F1[fold], thrhs[fold] = evaluate(model, validLoader, validset.scaler, devices, criterion, sr, threshold=None, model_path=model_path, jobname=f'{jobname}_SI_fold_{fold}_valid', print_output=False)
             test_loss, test_accs[fold], test_F1[fold], threshold = evaluate(model, testLoader, testset.scaler, devices, criterion, sr, threshold=thrhs[fold], model_path=model_path, jobname=f'{jobname}_SI_fold_{fold}_test', print_output=False)                
             if type(loaded_data) is list: # single DS evaluation
-                ds_config = copy.deepcopy(dataset_params)
-                ds_config['min_seed'] = 1
-                ds_config['max_seed'] = 1
-                ds_config['name'] = ['ExperimentalERPDataset']
-                _, _, mixed_testset1 = get_mixed_splited_datasets(fold, loaded_data, splits, ds_config)
-                ds_config['name'] = ['ExperimentalERPDataset']
-                ds_config['upsampling'] = False
-                _, _, mixed_testset2 = get_mixed_splited_datasets(fold, loaded_data, splits, ds_config)
-                for ds1, ds2, idx in zip(mixed_testset1, mixed_testset2, range(len(mixed_testset1))):
-                    loader1 = DataLoader(dataset=ds1, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
-                    loader2 = DataLoader(dataset=ds2, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
-                    _, separated_accs[0,idx,fold], separated_F1[0,idx,fold],_ = evaluate(model, loader1, ds1.scaler, devices, criterion, sr, threshold=thrhs[fold], model_path=model_path, jobname=f'{jobname}_SI_ds_{idx}_fold_{fold}', print_output=False)
-                    _, separated_accs[1,idx,fold], separated_F1[1,idx,fold],_ = evaluate(model, loader2, ds2.scaler, devices, criterion, sr, threshold=thrhs[fold], model_path=model_path, jobname=f'{jobname}_SI_ds_{idx}_fold_{fold}', print_output=False, weighted=True)          
-                    del ds1, ds2                        
+                predictions = predict(model, get_single_testsets(fold, loaded_data, splits, dataset_params), devices, batch_size, num_workers, model_path)
+                accs, F1 = single_ds_metrics(predictions, thrhs[fold])
+                separated_accs[:, :accs.shape[1], fold], separated_F1[:, :F1.shape[1], fold] = accs, F1
+                del predictions
             del trainset, validset, testset, mixed_trainset, mixed_validset, mixed_testset
             logger.info(f'Fold {fold} results:')
             logger.info(f'valid_loss: {train_loss}')
@@ -202,6 +187,8 @@ def trainAndCrossValidate(config, jobname):
     os.makedirs(output_path, exist_ok=True)
     
     dataset_params = config['dataset']
+    if getSeed(dataset_params) is not None:
+        seed_rng(getSeed(dataset_params))
     data_folder = os.path.expandvars(dataset_params['folder'])
     data_files = dataset_params['pre_processed']
     # scaler_path = os.path.expandvars(dataset_params['scaler_path']) if dataset_params['scaler_path'] != None else None
@@ -255,31 +242,22 @@ def trainAndCrossValidate(config, jobname):
     separated_accs = np.zeros((2, 15, NUM_SBJS))
     separated_F1 = np.zeros((2, 15, NUM_SBJS))    
     if type(data_files) is list:
-        loaded_data = []
-        for f in data_files:
-            path = os.path.join(data_folder, f)
-            loaded_data.append(makeERPdata(path))
+        build_workers = dataset_params['build_workers'] if 'build_workers' in dataset_params else 1
+        loaded_data = makeERPdatasets([os.path.join(data_folder, f) for f in data_files], build_workers)
         if dataset_params['scaler']['type'] is not None:
             scaler_path = os.path.expandvars(dataset_params['scaler']['path'])
             if os.path.exists(scaler_path):
                 scaler = joblib.load(scaler_path)
             else:
-                X = []
-                for data in loaded_data:
-                    new_X = np.concatenate(data['X'])
-                    X.append(new_X)
-                X = 1e6*np.concatenate(X)
-                data_shape = X.shape
-                logger.info(f'Raw data shape: {data_shape}')
-                X = X.reshape(-1, 1)
+                logger.info(f'Raw data epochs: {sum(len(X) for data in loaded_data for X in data["X"])}')
                 if dataset_params['scaler']['type'] == 'MinMaxScaler':
                     feature_range = tuple(dataset_params['scaler']['feature_range'])
                     scaler = eval(dataset_params['scaler']['type'])(feature_range=feature_range)
                 else:
                     scaler = RobustScaler(quantile_range=(5.0, 95.0))   
-                scaler.fit_transform(X)
-                joblib.dump(scaler, scaler_path)                
-                del X
+                # one streaming pass over the subjects instead of a concatenated copy
+                fitScaler(scaler, [X for data in loaded_data for X in data['X']], factor=1e6)
+                joblib.dump(scaler, scaler_path)
                 
     else:
         path = os.path.join(data_folder, data_files)
@@ -315,9 +293,9 @@ def trainAndCrossValidate(config, jobname):
             testset = MixedERPDataset([trs,vs,ts], scaler)            
         
         # dataloader
-        trainLoader = DataLoader(dataset=trainset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
-        validLoader = DataLoader(dataset=validset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
-        testLoader = DataLoader(dataset=testset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)       
+        trainLoader = makeDataLoader(dataset=trainset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
+        validLoader = makeDataLoader(dataset=validset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
+        testLoader = makeDataLoader(dataset=testset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)       
         model_path = os.path.join(output_path, f"{model_params['model_name']}_CS_{i}.pth")
         # model
         lossClass = loss_params['name']
@@ -340,25 +318,10 @@ def trainAndCrossValidate(config, jobname):
         train_loss, train_accs[i], train_F1[i], thrhs[i] = evaluate(model, validLoader, validset.scaler, device, criterion, sr, threshold=None, model_path=model_path, jobname=f'{jobname}_CS_{i}_valid', print_output=False)
         test_loss, test_accs[i], test_F1[i], threshold = evaluate(model, testLoader, testset.scaler, device, criterion, sr, threshold=thrhs[i], model_path=model_path, jobname=f'{jobname}_CS_{i}_test', print_output=False)
         if type(loaded_data) is list: # single DS evaluation
-            ds_config = copy.deepcopy(dataset_params)
-            ds_config['min_seed'] = 1
-            ds_config['max_seed'] = 1
-            ds_config['name'] = ['ExperimentalERPDataset']
-            mixed_trainset, mixed_validset, mixed_testset = get_mixed_splited_datasets(0, loaded_data, splits, ds_config, test_idxs)
-            for tr, v, t, idx in zip(mixed_trainset, mixed_validset, mixed_testset, range(len(mixed_validset))):
-                ds = MixedERPDataset([tr,v,t], scaler)
-                loader = DataLoader(dataset=ds, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
-                _, separated_accs[0,idx,i], separated_F1[0,idx,i],_ = evaluate(model, loader, ds.scaler, device, criterion, sr, threshold=thrhs[i], model_path=model_path, jobname=f'{jobname}_CS_{i}_ds_{idx}', print_output=False)
-                del ds
-            ds_config['name'] = ['ExperimentalERPDataset']
-            ds_config['upsampling'] = False                    
-            mixed_trainset, mixed_validset, mixed_testset = get_mixed_splited_datasets(0, loaded_data, splits, ds_config, test_idxs)
-            for tr, v, t, idx in zip(mixed_trainset, mixed_validset, mixed_testset, range(len(mixed_validset))):
-                ds = MixedERPDataset([tr,v,t], scaler)
-                loader = DataLoader(dataset=ds, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
-                _, separated_accs[1,idx,i], separated_F1[1,idx,i],_ = evaluate(model, loader, ds.scaler, device, criterion, sr, threshold=thrhs[i], model_path=model_path, jobname=f'{jobname}_CS_{i}_ds_{idx}', print_output=False, weighted=True)
-                del ds                        
-            del mixed_trainset, mixed_validset, mixed_testset, trs, vs, ts
+            predictions = predict(model, get_single_testsets(0, loaded_data, splits, dataset_params, test_idxs, all_splits=True), device, batch_size, num_workers, model_path)
+            accs, F1 = single_ds_metrics(predictions, thrhs[i])
+            separated_accs[:, :accs.shape[1], i], separated_F1[:, :F1.shape[1], i] = accs, F1
+            del predictions, trs, vs, ts
         del trainset, validset, testset    
         logger.info(f'train_accs: {train_accs}')
         logger.info(f'test_accs: {test_accs}')
@@ -379,6 +342,8 @@ def trainSubjecSpecific(config, jobname):
     os.makedirs(output_path, exist_ok=True)
     
     dataset_params = config['dataset']
+    if getSeed(dataset_params) is not None:
+        seed_rng(getSeed(dataset_params))
     data_folder = os.path.expandvars(dataset_params['folder'])
     data_files = dataset_params['pre_processed']
     # scaler_path = os.path.expandvars(dataset_params['scaler_path']) if dataset_params['scaler_path'] != None else None
@@ -433,31 +398,22 @@ def trainSubjecSpecific(config, jobname):
     separated_F1 = np.zeros((2, 15, NUM_SBJS, nFold)) 
     
     if type(data_files) is list:
-        loaded_data = []
-        for f in data_files:
-            path = os.path.join(data_folder, f)
-            loaded_data.append(makeERPdata(path))
+        build_workers = dataset_params['build_workers'] if 'build_workers' in dataset_params else 1
+        loaded_data = makeERPdatasets([os.path.join(data_folder, f) for f in data_files], build_workers)
         if dataset_params['scaler']['type'] is not None:
             scaler_path = os.path.expandvars(dataset_params['scaler']['path'])
             if os.path.exists(scaler_path):
                 scaler = joblib.load(scaler_path)
             else:
-                X = []
-                for data in loaded_data:
-                    new_X = np.concatenate(data['X'])
-                    X.append(new_X)
-                X = 1e6*np.concatenate(X)
-                data_shape = X.shape
-                logger.info(f'Raw data shape: {data_shape}')
-                X = X.reshape(-1, 1)
+                logger.info(f'Raw data epochs: {sum(len(X) for data in loaded_data for X in data["X"])}')
                 if dataset_params['scaler']['type'] == 'MinMaxScaler':
                     feature_range = tuple(dataset_params['scaler']['feature_range'])
                     scaler = eval(dataset_params['scaler']['type'])(feature_range=feature_range)
                 else:
                     scaler = RobustScaler(quantile_range=(5.0, 95.0))   
-                scaler.fit_transform(X)
-                joblib.dump(scaler, scaler_path)                
-                del X                
+                # one streaming pass over the subjects instead of a concatenated copy
+                fitScaler(scaler, [X for data in loaded_data for X in data['X']], factor=1e6)
+                joblib.dump(scaler, scaler_path)
     else:
         path = os.path.join(data_folder, data_files)
         loaded_data = makeERPdata(path)
@@ -479,9 +435,9 @@ def trainSubjecSpecific(config, jobname):
                 trainset, validset, testset = get_splited_datasets(fold, loaded_data, splits, dataset_params, [i])
             
             # dataloader
-            trainLoader = DataLoader(dataset=trainset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
-            validLoader = DataLoader(dataset=validset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
-            testLoader = DataLoader(dataset=testset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)       
+            trainLoader = makeDataLoader(dataset=trainset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
+            validLoader = makeDataLoader(dataset=validset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
+            testLoader = makeDataLoader(dataset=testset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)       
             model_path = os.path.join(output_path, f"{model_params['model_name']}_SS_{i}_fold_{fold}.pth")
             # model
             lossClass = loss_params['name']
@@ -505,20 +461,10 @@ def trainSubjecSpecific(config, jobname):
             test_loss, test_accs[i, fold], test_F1[i, fold], threshold = evaluate(model, testLoader, testset.scaler, device, criterion, sr, threshold=thrhs[i, fold], model_path=model_path, jobname=f'{jobname}_SS_{i}_fold_{fold}_test', print_output=True)
             
             if type(loaded_data) is list: # single DS evaluation
-                ds_config = copy.deepcopy(dataset_params)
-                ds_config['min_seed'] = 1
-                ds_config['max_seed'] = 1
-                ds_config['name'] = ['ExperimentalERPDataset']
-                _, _, mixed_testset1 = get_mixed_splited_datasets(fold, loaded_data, splits, ds_config, [i])
-                ds_config['name'] = ['ExperimentalERPDataset']
-                ds_config['upsampling'] = False
-                _, _, mixed_testset2 = get_mixed_splited_datasets(fold, loaded_data, splits, ds_config, [i])
-                for ds1, ds2, idx in zip(mixed_testset1, mixed_testset2, range(len(mixed_testset1))):
-                    loader1 = DataLoader(dataset=ds1, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
-                    loader2 = DataLoader(dataset=ds2, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
-                    _, separated_accs[0,idx, i, fold], separated_F1[0,idx,i,fold],_ = evaluate(model, loader1, ds1.scaler, devices, criterion, sr, threshold=thrhs[i, fold], model_path=model_path, jobname=f'{jobname}_SI_ds_{idx}_fold_{fold}', print_output=False)
-                    _, separated_accs[1,idx, i, fold], separated_F1[1,idx,i,fold],_ = evaluate(model, loader2, ds2.scaler, devices, criterion, sr, threshold=thrhs[i, fold], model_path=model_path, jobname=f'{jobname}_SI_ds_{idx}_fold_{fold}', print_output=False, weighted=True)          
-                    del ds1, ds2                      
+                predictions = predict(model, get_single_testsets(fold, loaded_data, splits, dataset_params, [i]), devices, batch_size, num_workers, model_path)
+                accs, F1 = single_ds_metrics(predictions, thrhs[i, fold])
+                separated_accs[:, :accs.shape[1], i, fold], separated_F1[:, :F1.shape[1], i, fold] = accs, F1
+                del predictions
                 
             del trainset, validset, testset
         logger.info(f'train_accs: {np.mean(train_accs, -1, keepdims=False)[i]}')
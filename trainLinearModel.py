@@ -2,14 +2,15 @@ import os
 import yaml
 import argparse
 import copy
+import json
+import hashlib
+from functools import partial
 import numpy as np
 import torch
 import torch.nn as nn
 from torch.nn import BCELoss, MSELoss, CrossEntropyLoss, BCEWithLogitsLoss
 from torch.optim import *
 from torch.optim.lr_scheduler import StepLR
-from scipy.io import loadmat
-import sklearn
 from sklearn.model_selection import KFold, GroupKFold, train_test_split
 
 from eventaad.AEC import *
@@ -17,120 +18,174 @@ from eventaad.EEGModels import *
 from eventaad.dataset import *
 import eventaad.loss as L
 from eventaad.loss import *
+from eventaad.linear import StreamingRidge, RidgeStats, accumulate_stats
+from eventaad.store import source_fingerprint, getStorePath, INDEX_FILE
 from utils.parallel import *
-from utils.utils import pearson_scorer
+from utils.utils import pearson_score, cumulative_moments, sliding_pearson
 from utils import logging
 logger = logging.getLogger()
 
 RIDGE_ALPHAS = tuple(10**(i/2) for i in range(-4,10))
+RIDGE_FOLDS = 5
+
+def concat_eeg(eegs):
+    # lazy subjects hold lists of per-trial lag matrices that are never concatenated.
+    if isinstance(eegs[0], list):
+        return [trial for eeg in eegs for trial in eeg]
+    return np.concatenate(eegs)
   
-def trainLinearEnvelope(model_config, trainset, testset, windows, sr, eeg_context, step=1.0):
+def concat_event_index(evt_indexes, lengths):
+    # window starts are shifted by the samples of the preceding subjects.
+    offsets = np.cumsum([0] + list(lengths[:-1]))
+    evt_index = {'windows': evt_indexes[0]['windows']}
+    for key in ('attd', 'unattd'):
+        evt_index[key] = np.concatenate([np.where(idx[key] >= 0, idx[key]+offset, -1) for idx, offset in zip(evt_indexes, offsets)])
+    return evt_index
+
+def event_accuracy(moments_attn, moments_unattn, starts, lengths):
+    """Accuracy over the valid event windows (starts >= 0) of each window length."""
+    valid = starts >= 0
+    starts = np.where(valid, starts, 0)
+    lengths = np.where(valid, lengths[None,:], 0)
+    correct = sliding_pearson(moments_attn, lengths, starts) >= sliding_pearson(moments_unattn, lengths, starts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (correct & valid).sum(axis=0)/valid.sum(axis=0)
+
+def getSubjectStats(subject_data, data_file, dataset_params, cache_folder=None, random_state=0, chunk_size=4096):
+    """Ridge sufficient statistics of one subject, cached on disk when cache_folder is set.
+    
+    subject_data is the data of the subject or a loader of it, only loaded on a cache miss.
+    Returns the RidgeStats, or the path of the cached file so that only the statistics
+    of the held-out subject have to be resident.
+    """
+    cache_path = None
+    if cache_folder is not None:
+        scaler_path = dataset_params['scaler']['path']
+        scaler_path = os.path.expandvars(scaler_path) if scaler_path is not None else None
+        # a trial store may be shipped without its .mat source, it is then fingerprinted.
+        source = data_file if os.path.exists(data_file) else os.path.join(getStorePath(data_file), INDEX_FILE)
+        key = {
+            'file': [os.path.abspath(data_file)] + source_fingerprint(source).tolist(),
+            'scaler': [scaler_path, source_fingerprint(scaler_path).tolist() if scaler_path is not None and os.path.exists(scaler_path) else None],
+            'channels': list(dataset_params['channels']),
+            'eeg_context': dataset_params['eeg_context'],
+            'aud_context': dataset_params['aud_context'] if 'aud_context' in dataset_params else None,
+            'folds': RIDGE_FOLDS,
+            'random_state': int(random_state),
+            'chunk_size': int(chunk_size),
+        }
+        key = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        name = os.path.splitext(os.path.basename(data_file))[0]
+        cache_path = os.path.join(cache_folder, f'{name}_ridge_{key}.npz')
+        if os.path.exists(cache_path):
+            logger.info(f'Loading cached ridge statistics: {cache_path}')
+            return cache_path
+    (eeg, attd_env) = loadSubject(subject_data)[:2]
+    stats = accumulate_stats(eeg, attd_env, n_folds=RIDGE_FOLDS, random_state=random_state, chunk_size=chunk_size)
+    if cache_path is not None:
+        os.makedirs(cache_folder, exist_ok=True)
+        stats.save(cache_path)
+        return cache_path
+    return stats
+    
+def loadSubject(sbj):
+    return sbj() if callable(sbj) else sbj
+    
+def predictSubjects(model, subjects, chunk_size=4096):
+    """Predictions, envelopes, events and event index of subjects concatenated in time.
+    
+    subjects holds subject data or loaders of it, each subject is loaded, predicted and
+    released before the next one, so only one subject's EEG is resident.
+    """
+    preds, attd_envs, unattd_envs, attd_evts, unattd_evts, evt_indexes = [], [], [], [], [], []
+    for sbj in subjects:
+        (eeg, attd_env, unattd_env, attd_evt, unattd_evt, _, evt_index) = loadSubject(sbj)
+        preds.append(model.predict(concat_eeg([eeg]), chunk_size=chunk_size))
+        attd_envs.append(attd_env)
+        unattd_envs.append(unattd_env)
+        attd_evts.append(attd_evt)
+        unattd_evts.append(unattd_evt)
+        evt_indexes.append(evt_index)
+        del eeg
+    evt_index = concat_event_index(evt_indexes, [len(env) for env in attd_envs])
+    return (np.concatenate(preds), np.concatenate(attd_envs), np.concatenate(unattd_envs),
+            np.concatenate(attd_evts), np.concatenate(unattd_evts), evt_index)
+    
+def trainLinearEnvelope(model_config, trainset, testset, windows, sr, eeg_context, step=1.0, stats=None):
+    """trainset and testset are the data of one subject, or lists of the data of subjects
+    or of loaders of it (see predictSubjects)."""
+    chunk_size = model_config['chunk_size'] if 'chunk_size' in model_config else 4096
+    model = StreamingRidge(alphas=RIDGE_ALPHAS, n_folds=RIDGE_FOLDS, random_state=0)
     if isinstance(trainset, list):
-        eeg_tr = np.concatenate([tr[0] for tr in trainset])
-        attd_env_tr = np.concatenate([tr[1] for tr in trainset])
-        unattd_env_tr = np.concatenate([tr[2] for tr in trainset])
-        attd_evt_tr = np.concatenate([tr[3] for tr in trainset])
-        unattd_evt_tr = np.concatenate([tr[4] for tr in trainset])
-        group=0
-        for i in range(len(trainset)):
-            (_,_,_,_,_, groups_tr) = trainset[i]
-            unique_tr, counts = np.unique(groups_tr, return_counts=True)
-            for j in range(len(unique_tr)):
-                trainset[i][5][groups_tr==unique_tr[j]] = group
-                group+=1
-        groups_tr = np.concatenate([tr[5] for tr in trainset])        
-        #
-        eeg_te = np.concatenate([te[0] for te in testset])
-        attd_env_te = np.concatenate([te[1] for te in testset])
-        unattd_env_te = np.concatenate([te[2] for te in testset])
-        attd_evt_te = np.concatenate([te[3] for te in testset])
-        unattd_evt_te = np.concatenate([te[4] for te in testset])
-        group=0
-        for i in range(len(testset)):
-            (_,_,_,_,_, groups_te) = testset[i]
-            unique_te, counts = np.unique(groups_te, return_counts=True)
-            for j in range(len(unique_te)):
-                testset[i][5][groups_te==unique_te[j]] = group
-                group+=1
-        groups_te = np.concatenate([te[5] for te in testset])
+        if stats is None:
+            trainset = [loadSubject(tr) for tr in trainset]
+            model.fit(concat_eeg([tr[0] for tr in trainset]), np.concatenate([tr[1] for tr in trainset]), chunk_size=chunk_size)
+        else:
+            model.solve(stats)
+        (pred_tr, attd_env_tr, unattd_env_tr, _, _, _) = predictSubjects(model, trainset, chunk_size)
+        (pred_te, attd_env_te, unattd_env_te, attd_evt_te, unattd_evt_te, evt_index_te) = predictSubjects(model, testset, chunk_size)
     else:
-        (eeg_tr, attd_env_tr, unattd_env_tr, attd_evt_tr, unattd_evt_tr, groups_tr) = trainset
-        (eeg_te, attd_env_te, unattd_env_te, attd_evt_te, unattd_evt_te, groups_te) = testset
-    unique_tr, counts = np.unique(groups_tr, return_counts=True)
-    unique_te, counts = np.unique(groups_te, return_counts=True)
-    # train
-    # cv_gen = GroupKFold(n_splits=5).split(eeg_tr, attd_env_tr, groups=groups_tr)    
-    cv_gen = KFold(n_splits=5, shuffle=True, random_state=0)
-    model = sklearn.linear_model.RidgeCV(alphas=RIDGE_ALPHAS, fit_intercept=True, scoring=pearson_scorer, cv=cv_gen, gcv_mode=None)
-    model.fit(eeg_tr, attd_env_tr)
+        (eeg_tr, attd_env_tr, unattd_env_tr, attd_evt_tr, unattd_evt_tr, groups_tr, _) = trainset
+        (eeg_te, attd_env_te, unattd_env_te, attd_evt_te, unattd_evt_te, groups_te, evt_index_te) = testset
+        # cv_gen = GroupKFold(n_splits=5).split(eeg_tr, attd_env_tr, groups=groups_tr)    
+        if stats is not None:
+            model.solve(stats)
+        else:
+            model.fit(eeg_tr, attd_env_tr, chunk_size=chunk_size)
+        pred_tr = model.predict(eeg_tr, chunk_size=chunk_size)
+        pred_te = model.predict(eeg_te, chunk_size=chunk_size)
+    if evt_index_te['windows'] != list(windows):
+        evt_index_te = {
+            'windows': list(windows),
+            'attd': makeEventIndex(attd_evt_te, len(attd_env_te), windows, sr, eeg_context),
+            'unattd': makeEventIndex(unattd_evt_te, len(attd_env_te), windows, sr, eeg_context),
+        }
                
-    # evaluate
+    # evaluate, all windows are scored from prefix sums of the predictions.
+    moments_attn_tr = cumulative_moments(attd_env_tr, pred_tr)
+    moments_unattn_tr = cumulative_moments(unattd_env_tr, pred_tr)
+    moments_attn_te = cumulative_moments(attd_env_te, pred_te)
+    moments_unattn_te = cumulative_moments(unattd_env_te, pred_te)
     train_accs = []
     test_accs = []
-    test_accs_evt = []
     step = 1 if int(step*sr)==0 else int(step*sr)
     for w in windows:
         L = int(w*sr)
-        score_attn_tr = []
-        score_unattn_tr = []
-        score_attn_te = []
-        score_unattn_te = []
-
-        start = 0
-        end = start + L
-        while end<=attd_env_tr.shape[0]:
-            score_attn_tr.append(pearson_scorer(model, eeg_tr[start:end], attd_env_tr[start:end]))
-            score_unattn_tr.append(pearson_scorer(model, eeg_tr[start:end], unattd_env_tr[start:end]))                
-            start += step
-            end += step
-            
-        start = 0
-        end = start + L
-        while end<=attd_env_te.shape[0]:
-            score_attn_te.append(pearson_scorer(model, eeg_te[start:end], attd_env_te[start:end]))
-            score_unattn_te.append(pearson_scorer(model, eeg_te[start:end], unattd_env_te[start:end]))                
-            start += step
-            end += step     
-
-        score_attn_tr = np.array(score_attn_tr)   
-        score_unattn_tr = np.array(score_unattn_tr)
-        score_attn_te = np.array(score_attn_te)
-        score_unattn_te = np.array(score_unattn_te) 
+        score_attn_tr = sliding_pearson(moments_attn_tr, L, step=step)
+        score_unattn_tr = sliding_pearson(moments_unattn_tr, L, step=step)
+        score_attn_te = sliding_pearson(moments_attn_te, L, step=step)
+        score_unattn_te = sliding_pearson(moments_unattn_te, L, step=step)
         train_accs.append((score_attn_tr>=score_unattn_tr).astype(float).mean())
         test_accs.append((score_attn_te>=score_unattn_te).astype(float).mean())        
         
-        # test on event locations only
-        score_attn_te_evt = []
-        score_unattn_te_evt = []        
-        for i in attd_evt_te:
-            start = i-int((w-eeg_context)*sr/2)
-            end = start + L
-            if end<=attd_env_te.shape[0]:
-                score_attn_te_evt.append(pearson_scorer(model, eeg_te[start:end], attd_env_te[start:end]))
-                score_unattn_te_evt.append(pearson_scorer(model, eeg_te[start:end], unattd_env_te[start:end]))
-        score_attn_te_evt = np.array(score_attn_te_evt)
-        score_unattn_te_evt = np.array(score_unattn_te_evt)
-        attd_acc = (score_attn_te_evt>=score_unattn_te_evt).astype(float).mean()
-        
-        score_attn_te_evt = []
-        score_unattn_te_evt = []               
-        for i in unattd_evt_te:
-            start = i-int((w-eeg_context)*sr/2)
-            end = start + L
-            if end<=attd_env_te.shape[0]:
-                score_attn_te_evt.append(pearson_scorer(model, eeg_te[start:end], attd_env_te[start:end]))
-                score_unattn_te_evt.append(pearson_scorer(model, eeg_te[start:end], unattd_env_te[start:end]))                
-        score_attn_te_evt = np.array(score_attn_te_evt)
-        score_unattn_te_evt = np.array(score_unattn_te_evt)
-        unattd_acc = (score_attn_te_evt>=score_unattn_te_evt).astype(float).mean()
-        
-        test_accs_evt.append((attd_acc+unattd_acc)/2)
+    # test on event locations only, all events and windows in one gather.
+    lengths = (np.asarray(windows)*sr).astype(int)
+    attd_acc = event_accuracy(moments_attn_te, moments_unattn_te, evt_index_te['attd'], lengths)
+    unattd_acc = event_accuracy(moments_attn_te, moments_unattn_te, evt_index_te['unattd'], lengths)
+    test_accs_evt = list((attd_acc+unattd_acc)/2)
             
     logger.info(f'train_accs: {train_accs}')
     logger.info(f'test_accs: {test_accs}') 
     logger.info(f'test_accs_evt: {test_accs_evt}') 
     return (np.array(train_accs), np.array(test_accs_evt))
       
+def openSubject(data_file, dataset_params, use_store):
+    """Lazy backward-model data of one subject, read from its memory-mapped trial store."""
+    preload_data = loadLinearData(data_file, use_store)
+    return getLinearEnvelopeData(config=dataset_params, loaded_data=preload_data, trial_idxs=None, lazy=True)
+    
+def crossTrainSubject(s, data_files, dataset_params, use_store, sbj_stats, total_stats, all_sbjs, model_params, windows, sr, eeg_context):
+    logger.info(f'{datetime.now().time().replace(microsecond=0)} --- '
+            f'********** cross-training Sbj {s} **********')                
+    # the model is solved from the statistics, the training subjects are only opened one
+    # at a time to score their windows.
+    trained_sbjs = np.delete(all_sbjs, s)                       
+    trainset = [partial(openSubject, data_files[i], dataset_params, use_store) for i in trained_sbjs]
+    testset = [openSubject(data_files[s], dataset_params, use_store)]
+    total_stats = RidgeStats.load(total_stats) if isinstance(total_stats, str) else total_stats
+    held_out = RidgeStats.load(sbj_stats[s]) if isinstance(sbj_stats[s], str) else sbj_stats[s]
+    return trainLinearEnvelope(model_params, trainset, testset, windows, sr, eeg_context, stats=total_stats-held_out)
+    
 def trainSubjecIndependent(config, jobname):
     setup_params = config['setup']
     name = setup_params['name']
@@ -154,6 +209,7 @@ def trainSubjecIndependent(config, jobname):
     windows = dataset_params['windows']
     eeg_context = round(dataset_params['eeg_context']*sr) + 1
     model_params = config['model']
+    use_store = dataset_params['use_store'] if 'use_store' in dataset_params else True
     
     # scaler for dataset
     scaler_path = dataset_params['scaler']['path']
@@ -169,7 +225,7 @@ def trainSubjecIndependent(config, jobname):
             #
             eeg_all = []
             for s in all_sbjs:
-                preload_data = loadmat(data_files[s], squeeze_me=True)
+                preload_data = loadLinearData(data_files[s], use_store)
                 eeg = np.concatenate(preload_data['eeg'], axis=0)
                 eeg_all.append(eeg)
             eeg_all = np.concatenate(eeg_all, axis=0)
@@ -181,25 +237,46 @@ def trainSubjecIndependent(config, jobname):
     test_accs = np.zeros((len(windows), num_sbjs))
     train_F1 = np.zeros((len(windows), num_sbjs))
     test_F1 = np.zeros((len(windows), num_sbjs))
+    
+    # every subject is accumulated once, LOSO folds reuse the statistics.
+    num_workers = setup_params['num_workers'] if 'num_workers' in setup_params else 1
+    max_in_flight = setup_params['max_in_flight'] if 'max_in_flight' in setup_params else None
+    cache_folder = os.path.expandvars(dataset_params['cache']) if 'cache' in dataset_params else None
+    if cache_folder is None and num_workers > 1:
+        # the workers read the statistics from disk.
+        cache_folder = os.path.join(output_path, 'ridge_stats')
+    chunk_size = model_params['chunk_size'] if 'chunk_size' in model_params else 4096
+    sbj_files = [data_files[s] for s in all_sbjs]
+    sbj_stats = []
+    for s in all_sbjs:
+        sbj_data = partial(openSubject, data_files[s], dataset_params, use_store)
+        sbj_stats.append(getSubjectStats(sbj_data, data_files[s], dataset_params, cache_folder, random_state=s, chunk_size=chunk_size))
+    total_stats = None
+    for stats in sbj_stats:
+        stats = RidgeStats.load(stats) if isinstance(stats, str) else stats
+        total_stats = stats if total_stats is None else total_stats + stats
+    if num_workers > 1:
+        key = hashlib.sha1(json.dumps(sbj_stats).encode()).hexdigest()
+        total_path = os.path.join(cache_folder, f'total_ridge_{key}.npz')
+        total_stats.save(total_path)
+        total_stats = total_path
         
-    for s in range(from_sbj, to_sbj):
-        logger.info(f'{datetime.now().time().replace(microsecond=0)} --- '
-                f'********** cross-training Sbj {s} **********')                
-        trainset = []
-        testset = []
-        trained_sbjs = np.delete(all_sbjs, s)                       
-        test_config = copy.deepcopy(dataset_params)
-        test_config['pre_processed'] = [dataset_params['pre_processed'][s]]
-        train_config = copy.deepcopy(dataset_params)
-        train_config['pre_processed'] = [dataset_params['pre_processed'][i] for i in trained_sbjs]            
-        for i in range(len(trained_sbjs)):
-            preload_data = loadmat(data_files[trained_sbjs[i]], squeeze_me=True)
-            trainset.append(getLinearEnvelopeData(config=train_config, loaded_data=preload_data, trial_idxs=None))
-            del preload_data            
-        preload_data = loadmat(data_files[s], squeeze_me=True)
-        testset.append(getLinearEnvelopeData(config=test_config, loaded_data=preload_data, trial_idxs=None))
-        del preload_data        
-        train_accs[:,s], test_accs[:,s] = trainLinearEnvelope(model_params, trainset, testset, windows, sr, eeg_context)
+    # held-out subjects are fanned out over the workers, results are collected as they complete.
+    # only paths are shared, the workers open the trial stores and the cached statistics.
+    shared = {
+        'data_files': sbj_files,
+        'dataset_params': dataset_params,
+        'use_store': use_store,
+        'sbj_stats': sbj_stats,
+        'total_stats': total_stats,
+        'all_sbjs': all_sbjs,
+        'model_params': model_params,
+        'windows': windows,
+        'sr': sr,
+        'eeg_context': eeg_context,
+    }
+    for s, accs in pool_imap(crossTrainSubject, range(from_sbj, to_sbj), shared, num_workers, max_in_flight):
+        train_accs[:,s], test_accs[:,s] = accs
         logger.info(f'sbj {s} valid_accs: {train_accs[...,s]}')
         logger.info(f'sbj {s} test_accs: {test_accs[...,s]}')    
     
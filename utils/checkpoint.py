@@ -0,0 +1,63 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from . import logging
+logger = logging.getLogger()
+
+class CheckpointManager:
+    """
+    Best state dicts of a run, kept in RAM as CPU copies and written to disk on a
+    background thread, so saving a checkpoint does not wait for the filesystem.
+    `load` serves a saved path from memory and only reads files it does not hold.
+    Writes of a path are coalesced: a queued write is skipped once a newer state of the
+    same path was saved. At most max_states states are kept, the least recently used
+    ones are dropped from memory after they are written.
+    """
+    def __init__(self, max_states=8):
+        self.max_states = max_states
+        self.states = OrderedDict()
+        self.versions = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def save(self, state_dict, path):
+        state = {k: v.detach().to('cpu', copy=True) for k, v in state_dict.items()}
+        with self.lock:
+            version = self.versions.get(path, 0) + 1
+            self.versions[path] = version
+            self.states[path] = state
+            self.states.move_to_end(path)
+            self.pending[path] = self.executor.submit(self.__write__, state, path, version)
+            while len(self.states) > self.max_states:
+                self.states.popitem(last=False)
+
+    def __write__(self, state, path, version):
+        with self.lock:
+            if self.versions[path] != version:
+                return
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        with self.lock:
+            if path in self.states:
+                self.states.move_to_end(path)
+                return self.states[path]
+            future = self.pending.get(path)
+        if future is not None:
+            future.result()
+        return torch.load(path)
+
+    def flush(self):
+        """Wait for all queued writes, raising the error of a failed one."""
+        with self.lock:
+            futures = list(self.pending.values())
+            self.pending.clear()
+        for future in futures:
+            future.result()
+
+checkpoints = CheckpointManager()
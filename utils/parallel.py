@@ -13,6 +13,9 @@ from eventaad.AEC import *
 from .utils import *
 from eventaad.loss import *
 from .running import *
+from .pool import *
+from .checkpoint import checkpoints
+from eventaad.cache import seed_rng, getSeed
 from . import logging
 logger = logging.getLogger()
 
@@ -26,7 +29,7 @@ def cleanup():
     
 def prepare(rank, world_size, dataset, batch_size=32, pin_memory=False, num_workers=0):
     sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=False, drop_last=False)    
-    dataloader = DataLoader(dataset, batch_size=batch_size, pin_memory=pin_memory, num_workers=num_workers, drop_last=False, shuffle=False, sampler=sampler)
+    dataloader = makeDataLoader(dataset, batch_size=batch_size, pin_memory=pin_memory, num_workers=num_workers, drop_last=False, sampler=sampler)
     
     return dataloader    
 
@@ -55,22 +58,17 @@ def data_job(rank, world_size, model, criterion, optimizer, scheduler, trainLoad
           f'Epoch: -1\t'
           f'Valid loss: {epoch_loss:.8f}\t'
           f'Valid accuracy: {100 * epoch_acc:.2f}')     
+    train_metrics = MetricsAccumulator(device, threshold)
     for epoch in range(epochs):
         trainLoader.sampler.set_epoch(epoch)
         #train
         model.train()
-        cur_loss = 0
-        cur_acc = 0
-        all_y_hat = []
-        all_y_true = []
-        data_count = 0
+        train_metrics.reset()
         for (X, erp, y_true, _) in trainLoader:
             optimizer.zero_grad(set_to_none=True)
-            batch_size = y_true.shape[0]
-            data_count += batch_size
-            X = X.to(device)
-            erp = erp.to(device)
-            y_true = y_true.to(device)
+            X = X.to(device, non_blocking=True)
+            erp = erp.to(device, non_blocking=True)
+            y_true = y_true.to(device, non_blocking=True)
             if isinstance(criterion, DualTask_AE_Loss):
                 X_pred, erp_hat, y_hat = model(X, erp, y_true)
                 loss = criterion(X_pred, y_hat, X, y_true)
@@ -78,20 +76,14 @@ def data_job(rank, world_size, model, criterion, optimizer, scheduler, trainLoad
                 erp_hat, y_hat = model(X, erp, y_true)
                 loss = criterion(y_hat, y_true)
                 
-            cur_loss += loss.item()*batch_size
-            cur_acc += binary_accuracy(y_hat.data,y_true.data,threshold).item()*batch_size
-            all_y_hat.append(y_hat.data)
-            all_y_true.append(y_true.data)            
+            train_metrics.update(y_hat, y_true, loss)
             loss.backward()
             optimizer.step()
             del X, erp, y_true, loss, erp_hat, y_hat
         scheduler.step()
-        epoch_loss = cur_loss/data_count
-        train_losses.append(epoch_loss)
-        epoch_acc = cur_acc/data_count
-        train_accs.append(epoch_acc)
-        (TP,FP,TN,FN,_,_) = metrics(torch.cat(all_y_hat), torch.cat(all_y_true), thresh=threshold)
-        del all_y_hat, all_y_true    
+        epoch_metrics = train_metrics.compute()
+        train_losses.append(epoch_metrics['loss'])
+        train_accs.append(epoch_metrics['acc'])
         # evaluate on validation set
         epoch_loss, epoch_acc,_,_ = evaluate(model, validLoader, None, device, criterion, None, threshold, None, jobname, print_output=False)
         valid_losses.append(epoch_loss)
@@ -103,7 +95,7 @@ def data_job(rank, world_size, model, criterion, optimizer, scheduler, trainLoad
             best_loss_valid = valid_losses[-1]
             best_accr_train = train_accs[-1]
             best_accr_valid = valid_accs[-1]
-            torch.save(model.module.state_dict(), model_path)
+            checkpoints.save(model.module.state_dict(), model_path)
         if epoch % 1 == 0:
             logger.info(f'{datetime.now().time().replace(microsecond=0)} --- device {device} '
                   f'Epoch: {epoch}\t'
@@ -111,7 +103,7 @@ def data_job(rank, world_size, model, criterion, optimizer, scheduler, trainLoad
                   f'Valid loss: {valid_losses[epoch]:.8f}\t'
                   f'Train accuracy: {100 * train_accs[epoch]:.2f}\t'
                   f'Valid accuracy: {100 * valid_accs[epoch]:.2f}') 
-            logger.info(f'\t\t\t TP: {TP} \t FP: {FP} \t TN: {TN} \t FN: {FN} --- F1: {2*TP/(2*TP+FP+FN):.5f}')     
+            logger.info(f'\t\t\t TP: {epoch_metrics["TP"]} \t FP: {epoch_metrics["FP"]} \t TN: {epoch_metrics["TN"]} \t FN: {epoch_metrics["FN"]} --- F1: {epoch_metrics["F1"]:.5f}')     
     plt.clf()
     plt.plot(train_accs,'b-', label="train accuracy")
     plt.plot(valid_accs,'r.', label="validation accuracy")
@@ -130,6 +122,7 @@ def data_job(rank, world_size, model, criterion, optimizer, scheduler, trainLoad
     filepath = os.path.join(os.path.dirname(model_path), f"{jobname}_loss_curve_device_{rank}.png") 
     plt.savefig(filepath, dpi=300, bbox_inches='tight')
     plt.close()
+    checkpoints.flush()
     
     #
     cleanup()
@@ -150,6 +143,8 @@ def fold_job(rank, world_size, devices, folds, loaded_data, scaler, splits, conf
     output_path = os.path.join(output_path, name)
     
     dataset_params = config['dataset']
+    if getSeed(dataset_params) is not None:
+        seed_rng(getSeed(dataset_params) + fold)
     data_folder = os.path.expandvars(dataset_params['folder'])
     data_files = dataset_params['pre_processed']
     upsampling = dataset_params['upsampling']
@@ -202,9 +197,9 @@ def fold_job(rank, world_size, devices, folds, loaded_data, scaler, splits, conf
         trainset, validset, testset = get_splited_datasets(fold, loaded_data, splits, dataset_params)
 
     # dataloader
-    trainLoader = DataLoader(dataset=trainset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
-    validLoader = DataLoader(dataset=validset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
-    testLoader = DataLoader(dataset=testset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)       
+    trainLoader = makeDataLoader(dataset=trainset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
+    validLoader = makeDataLoader(dataset=validset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
+    testLoader = makeDataLoader(dataset=testset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)       
     model_path = os.path.join(output_path, f"{model_params['model_name']}_SI_fold_{fold}.pth")
     # model
     if model_params['model_name'] not in ['CSP', 'TM', 'LDA']:
@@ -231,20 +226,10 @@ def fold_job(rank, world_size, devices, folds, loaded_data, scaler, splits, conf
     separated_accs = np.zeros((2, 12))
     separated_F1 = np.zeros((2, 12))
     if type(loaded_data) is list: # single DS evaluation
-        ds_config = copy.deepcopy(dataset_params)
-        ds_config['min_seed'] = 1
-        ds_config['max_seed'] = 1
-        ds_config['name'] = ['ExperimentalERPDataset']
-        _, _, mixed_testset1 = get_mixed_splited_datasets(fold, loaded_data, splits, ds_config)
-        ds_config['name'] = ['ExperimentalERPDataset']
-        ds_config['upsampling'] = False
-        _, _, mixed_testset2 = get_mixed_splited_datasets(fold, loaded_data, splits, ds_config)
-        for ds1, ds2, idx in zip(mixed_testset1, mixed_testset2, range(len(mixed_testset1))):
-            loader1 = DataLoader(dataset=ds1, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
-            loader2 = DataLoader(dataset=ds2, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
-            _, separated_accs[0, idx], separated_F1[0, idx],_ = evaluate(model, loader1, ds1.scaler, device, criterion, sr, threshold=thrhs, model_path=model_path, jobname=f'{jobname}_SI_ds_{idx}_fold_{fold}', print_output=False)
-            _, separated_accs[1, idx], separated_F1[1, idx],_ = evaluate(model, loader2, ds2.scaler, device, criterion, sr, threshold=thrhs, model_path=model_path, jobname=f'{jobname}_SI_ds_{idx}_fold_{fold}', print_output=False, weighted=True)          
-            del ds1, ds2
+        predictions = predict(model, get_single_testsets(fold, loaded_data, splits, dataset_params), device, batch_size, num_workers, model_path)
+        accs, F1 = single_ds_metrics(predictions, thrhs)
+        separated_accs[:, :accs.shape[1]], separated_F1[:, :F1.shape[1]] = accs, F1
+        del predictions
     del trainset, validset, testset, mixed_trainset, mixed_validset, mixed_testset
     data = {
         'rank': rank,
@@ -306,4 +291,3 @@ def fold_parallel(devices, folds, loaded_data, scaler, splits, config, jobname):
             separated_F1[...,fold_idx] = result['separated_F1']   
             del result
     return train_accs, test_accs, train_F1, test_F1, thrhs, separated_accs, separated_F1
-    
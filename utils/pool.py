@@ -0,0 +1,42 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from threadpoolctl import threadpool_limits
+
+_pool_shared = {}
+
+def _init_pool(shared, threads):
+    # shared data is received once per worker, not once per job.
+    _pool_shared.update(shared)
+    threadpool_limits(threads)
+    
+def _pool_job(job, item):
+    return job(item, **_pool_shared)
+    
+def pool_imap(job, items, shared=None, num_workers=1, max_in_flight=None):
+    """Run job(item, **shared) for all items over a process pool.
+    
+    Yields (item, result) as the jobs complete. At most max_in_flight jobs (default
+    num_workers) are submitted at a time, so finished results never pile up, and the
+    BLAS threads are split between the workers. With num_workers <= 1 the jobs run
+    serially in this process.
+    
+    shared is pickled into every worker, it should hold paths of memmapped stores or
+    cached files rather than the arrays themselves.
+    """
+    shared = {} if shared is None else shared
+    items = list(items)
+    if num_workers <= 1:
+        for item in items:
+            yield item, job(item, **shared)
+        return
+    max_in_flight = num_workers if max_in_flight is None else max(1, max_in_flight)
+    threads = max(1, os.cpu_count()//num_workers)
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_pool, initargs=(shared, threads)) as executor:
+        pending = {}
+        while items or pending:
+            while items and len(pending) < max_in_flight:
+                item = items.pop(0)
+                pending[executor.submit(_pool_job, job, item)] = item
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
@@ -4,6 +4,7 @@ import copy
 from datetime import datetime
 from sklearn.model_selection import KFold, train_test_split
 import numpy as np
+import pandas as pd
 import torch
 import torch.nn as nn
 from torch.nn import BCELoss, MSELoss, CrossEntropyLoss, BCEWithLogitsLoss
@@ -20,7 +21,9 @@ from eventaad.BaseNet import *
 from eventaad.EEGModels import *
 from eventaad.dataset import *
 from eventaad.loss import *
-from .utils import metrics, binary_accuracy
+from eventaad.cache import cachedBuild, get_rng_state, set_rng_state
+from .utils import metrics, binary_accuracy, MetricsAccumulator, ScoreHistogram
+from .checkpoint import checkpoints
 from . import logging
 logger = logging.getLogger()
 
@@ -49,7 +52,78 @@ def make_splits(loaded_data, nFold):
             splits.append(split)
         return splits
         
+def get_base_dataset(loaded_data, dataset_params):
+    """
+    ExperimentalERPDataset over all epochs of loaded_data, built once for each
+    preprocessing (channels, window, scaler, ERP types) and kept in loaded_data['bases'].
+    The on-disk cache is keyed by the same preprocessing only.
+    """
+    config = copy.deepcopy(dataset_params)
+    config['upsampling'] = False
+    channels_erp = config['channels_erp'] if 'channels_erp' in config.keys() else None
+    key = repr((config['channels'], channels_erp, config['sr'], config['start'], config['end'], config['scaler'], config['ERP_types']))
+    bases = loaded_data.setdefault('bases', {})
+    if key not in bases:
+        data = {k: v for k, v in loaded_data.items() if k != 'bases'}
+        data['X'] = list(data['X'])
+        data['y'] = list(data['y'])
+        build = lambda: ExperimentalERPDataset(config=config, loaded_data=data)
+        bases[key] = cachedBuild(build, config, loaded_data, use_rng=False, key_config=key)
+    return bases[key]
+    
+def fit_split_scaler(loaded_data, train_idxs, dataset_params, sbj_idxs):
+    """
+    Fits and saves the scaler of dataset_params on the training epochs train_idxs of the
+    subjects sbj_idxs, as the training set of get_splited_datasets does, so that the base
+    dataset shared by all splits is not scaled with statistics of the held-out epochs.
+    """
+    scaler_params = dataset_params['scaler']
+    if scaler_params['type'] is None or os.path.exists(os.path.expandvars(scaler_params['path'])):
+        return
+    data = {k: v for k, v in loaded_data.items() if k not in ('bases', 'ERP')}
+    data['X'] = [loaded_data['X'][i][idxs] for i, idxs in zip(sbj_idxs, train_idxs)]
+    data['y'] = [loaded_data['y'][i][idxs] for i, idxs in zip(sbj_idxs, train_idxs)]
+    # the global RNG state does not depend on whether the scaler was fitted before
+    state = get_rng_state()
+    try:
+        ExperimentalERPDataset(config=copy.deepcopy(dataset_params), loaded_data=data)
+    finally:
+        set_rng_state(state)
+    
+def get_splited_views(fold, loaded_data, splits, dataset_params, sbj_idxs=None):
+    """
+    Same splits as get_splited_datasets, as index views over the base dataset of loaded_data.
+    """
+    train_idxs = []
+    valid_idxs = []
+    test_idxs = []
+    if sbj_idxs is None:
+        sbj_idxs = range(len(loaded_data['X']))
+    for i in sbj_idxs:
+        test_idxs.append(splits[i][fold][1])
+        train, valid = train_test_split(splits[i][fold][0], random_state=i, test_size=0.2)
+        train_idxs.append(train)
+        valid_idxs.append(valid)
+    fit_split_scaler(loaded_data, train_idxs, dataset_params, sbj_idxs)
+    base = get_base_dataset(loaded_data, dataset_params)
+    offsets = base.sbj_index.offsets
+    shift = lambda idxs: [offsets[i] + idx for i, idx in zip(sbj_idxs, idxs)]
+    trainset = base.view(shift(train_idxs), dataset_params)
+    validset = base.view(shift(valid_idxs), dataset_params)
+    testset = base.view(shift(test_idxs), dataset_params)
+    return trainset, validset, testset
+        
 def get_splited_datasets(fold, loaded_data, splits, dataset_params, sbj_idxs=None):
+    if dataset_params['name'] == 'ExperimentalERPDataset':
+        # experimental epochs are only preprocessed once, splits are index views
+        return get_splited_views(fold, loaded_data, splits, dataset_params, sbj_idxs)
+    if sbj_idxs is None:
+        sbj_idxs = range(len(loaded_data['X']))
+    sbj_idxs = [int(i) for i in sbj_idxs]
+    build = lambda: build_splited_datasets(fold, loaded_data, splits, dataset_params, sbj_idxs)
+    return cachedBuild(build, dataset_params, loaded_data, fold, sbj_idxs, [splits[i][fold] for i in sbj_idxs])
+    
+def build_splited_datasets(fold, loaded_data, splits, dataset_params, sbj_idxs):
     train_X = []
     train_y = []
     valid_X = []
@@ -59,8 +133,6 @@ def get_splited_datasets(fold, loaded_data, splits, dataset_params, sbj_idxs=Non
     X = loaded_data['X']
     y = loaded_data['y']
         
-    if sbj_idxs is None:
-        sbj_idxs = range(len(X))
     for i in sbj_idxs:
         test_X.append(X[i][splits[i][fold][1]])
         test_y.append(y[i][splits[i][fold][1]])
@@ -98,14 +170,14 @@ def get_mixed_splited_datasets(fold, loaded_data, splits, dataset_params, sbj_id
             dataset_params['name'] = ds_type
             if ds_type == 'SimulatedERPDataset':
                 dataset_params['simulated'] = True
+                # one build for all SNR levels, they only differ by the gain of the target ERPs.
+                logger.info(f'generating mixed dataset {ds_type}, {SNRs} dB')
+                train, valid, test = get_splited_datasets(fold, loaded_data[i], splits[i], dataset_params, sbj_idxs)
                 for db in SNRs:
-                    logger.info(f'generating mixed dataset {ds_type}, {db} dB')
-                    dataset_params['SNR'] = db
-                    train, valid, test = get_splited_datasets(fold, loaded_data[i], splits[i], dataset_params, sbj_idxs)
-                    trainset.append(train)
-                    validset.append(valid)
-                    testset.append(test)
-                    del train, valid, test
+                    trainset.append(train.with_snr(db))
+                    validset.append(valid.with_snr(db))
+                    testset.append(test.with_snr(db))
+                del train, valid, test
             else:
                 logger.info(f'generating mixed dataset {ds_type}')
                 dataset_params['simulated'] = False
@@ -116,26 +188,122 @@ def get_mixed_splited_datasets(fold, loaded_data, splits, dataset_params, sbj_id
                 del train, valid, test
     return trainset, validset, testset
 
+def get_single_testsets(fold, loaded_data, splits, dataset_params, sbj_idxs=None, all_splits=False):
+    """
+    Tagged experimental test sets of every data file for the single DS evaluation,
+    variant 0 up-sampled with one epoch per average, variant 1 as recorded.
+    Returns a list of (dataset, tags) for `predict`, all_splits also adds the train and
+    valid splits of the subjects (LOSO test subject).
+    """
+    tagged = []
+    for variant, upsampling in enumerate((dataset_params['upsampling'], False)):
+        ds_config = copy.deepcopy(dataset_params)
+        ds_config['min_seed'] = 1
+        ds_config['max_seed'] = 1
+        ds_config['name'] = ['ExperimentalERPDataset']
+        ds_config['upsampling'] = upsampling
+        # single epoch averages stay views, predict shares them with the recorded epochs
+        ds_config['virtual'] = True
+        splited = get_mixed_splited_datasets(fold, loaded_data, splits, ds_config, sbj_idxs)
+        if not all_splits:
+            splited = splited[-1:]
+        for datasets in splited:
+            for i, ds in enumerate(datasets):
+                subjects = np.arange(len(loaded_data[i]['X'])) if sbj_idxs is None else np.asarray(sbj_idxs)
+                tagged.append((ds, {'file': i, 'type': 'ExperimentalERPDataset', 'snr': np.nan, 'variant': variant,
+                                    'upsampled': upsampling, 'subject': subjects[ds.sbj_ids]}))
+    return tagged
+    
+def predict(model, tagged, device, batch_size, num_workers=0, model_path=None):
+    """
+    Runs the model once over a tagged test store, a list of (dataset, tags) where tags are
+    scalars or per-epoch arrays (source file, dataset type, SNR, subject, ...).
+    Epochs that are the same source epoch (`source_rows`) of several datasets are only
+    predicted once. Returns a DataFrame of y_hat, y_true and the tags of every epoch.
+    """
+    if model_path is not None:
+        model.load_state_dict(checkpoints.load(model_path))
+    if type(device) is list:
+        device = device[0]
+    model.device = device
+    model.to(device)
+    model.eval()
+    predicted = {} # source epochs -> predictions of their rows, nan if not yet predicted
+    frames = []
+    for dataset, tags in tagged:
+        if hasattr(dataset, 'source_rows'):
+            rows = dataset.source_rows()
+            known = predicted.setdefault(id(dataset.X), np.full(len(dataset.X), np.nan, dtype=np.float32))
+        else:
+            rows = np.full(len(dataset), -1)
+            known = np.zeros(0, dtype=np.float32)
+        shared = rows >= 0
+        _, first = np.unique(rows[shared], return_index=True)
+        first = np.nonzero(shared)[0][first]
+        idxs = np.concatenate((first[np.isnan(known[rows[first]])], np.nonzero(~shared)[0]))
+        loader = makeDataLoader(dataset, batch_size=batch_size, sampler=idxs.tolist(), num_workers=num_workers)
+        outputs = []
+        with torch.no_grad():
+            for (X, erp, y_true, _) in loader:
+                X = X.to(device, dtype=torch.float, non_blocking=True)
+                erp = erp.to(device, dtype=torch.float, non_blocking=True)
+                y_true = y_true.to(device, dtype=torch.float, non_blocking=True)
+                outputs.append(model(X, erp, y_true)[-1])
+        outputs = torch.cat(outputs).cpu().numpy() if len(outputs) else np.zeros(0, dtype=np.float32)
+        y_hat = np.empty(len(dataset), dtype=np.float32)
+        ran = shared[idxs]
+        known[rows[idxs[ran]]] = outputs[ran]
+        y_hat[shared] = known[rows[shared]]
+        y_hat[idxs[~ran]] = outputs[~ran]
+        columns = {'y_hat': y_hat, 'y_true': np.asarray(dataset.y, dtype=np.float32), 'subject': dataset.sbj_ids}
+        columns.update(tags)
+        frames.append(pd.DataFrame(columns))
+    return pd.concat(frames, ignore_index=True)
+    
+def group_metrics(predictions, by, threshold, weighted=False):
+    """
+    `metrics` at threshold of every group of the predictions of `predict`.
+    Returns a DataFrame of acc, F1 and the number of epochs n, indexed by the groups.
+    """
+    results = {}
+    for key, group in predictions.groupby(by, sort=True):
+        y_hat = torch.tensor(group['y_hat'].to_numpy())
+        y_true = torch.tensor(group['y_true'].to_numpy())
+        (TP,FP,TN,FN,acc,_) = metrics(y_hat, y_true, thresh=float(threshold), weighted=weighted)
+        results[key] = {'acc': acc.item(), 'F1': (2*TP/(2*TP+FP+FN)).item(), 'n': len(group)}
+    return pd.DataFrame.from_dict(results, orient='index')
+    
+def single_ds_metrics(predictions, threshold):
+    """
+    separated accs and F1 (2, nfiles) of the single DS evaluation: the up-sampled test sets,
+    then the recorded ones with weighted accuracy. Per-subject results are logged.
+    """
+    accs, F1 = [], []
+    for variant, weighted in ((0, False), (1, True)):
+        selected = predictions[predictions['variant'] == variant]
+        results = group_metrics(selected, 'file', threshold, weighted)
+        accs.append(results['acc'].to_numpy())
+        F1.append(results['F1'].to_numpy())
+        logger.info(f'single DS variant {variant} per-subject results:\n{group_metrics(selected, ["file", "subject"], threshold, weighted)}')
+    return np.array(accs), np.array(F1)
+    
 def evaluate(model, data_loader, scaler, device, criterion, sr=None, threshold=None, model_path=None, jobname=None, print_output=False, weighted=False):
     '''
     Calculating accuracy of model
     '''
     if model_path is not None:
-        model.load_state_dict(torch.load(model_path))
+        model.load_state_dict(checkpoints.load(model_path))
     if type(device) is list:
         device = device[0]
     model.device = device
     model.to(device)
     model.eval()
-    total_loss = 0.0
-    total_erp_loss = 0.0
-    all_y_hat = []
-    all_y_true = []
+    accumulator = MetricsAccumulator(device)
+    histogram = ScoreHistogram(device, extra=[] if threshold is None else [threshold])
     for (X, erp, y_true, _) in data_loader:
-        batch_size = X.shape[0]
-        X = X.to(device, dtype=torch.float)
-        erp = erp.to(device, dtype=torch.float)
-        y_true = y_true.to(device, dtype=torch.float)
+        X = X.to(device, dtype=torch.float, non_blocking=True)
+        erp = erp.to(device, dtype=torch.float, non_blocking=True)
+        y_true = y_true.to(device, dtype=torch.float, non_blocking=True)
         with torch.no_grad():
             if isinstance(criterion, DualTask_AE_Loss):
                 X_pred, erp_hat, y_hat = model(X, erp, y_true)
@@ -143,20 +311,17 @@ def evaluate(model, data_loader, scaler, device, criterion, sr=None, threshold=N
             else:
                 erp_hat, y_hat = model(X, erp, y_true)
                 loss = criterion(y_hat, y_true) 
-            all_y_hat.append(y_hat.data)
-            all_y_true.append(y_true.data)
-        total_loss += loss.item()*batch_size
+            accumulator.update(y_hat, y_true, loss)
+            histogram.update(y_hat, y_true)
         del X, erp, y_true, loss, erp_hat, y_hat
-        torch.cuda.empty_cache()
-    (TP,FP,TN,FN,acc,threshold) = metrics(torch.cat(all_y_hat), torch.cat(all_y_true), thresh=threshold, weighted=weighted)
-    avg_loss = total_loss/len(data_loader.dataset)
-    avr_erp_loss = total_erp_loss/len(data_loader.dataset)
-    avg_accr = acc.item()
-    F1 = (2*TP/(2*TP+FP+FN)).item()
+    (TP,FP,TN,FN,avg_accr,threshold) = histogram.metrics(thresh=threshold, weighted=weighted)
+    avg_loss = accumulator.compute()['loss']
+    F1 = 2*TP/(2*TP+FP+FN) if (2*TP+FP+FN) > 0 else float('nan')
     
     if print_output:
         filename = os.path.join(os.path.dirname(model_path), f"{jobname}") 
-        plot_confusion_matrix(torch.cat(all_y_true).cpu(), (torch.cat(all_y_hat)>threshold).cpu(), ['Unattended', 'Attended'], filename=filename+'_confusion_matrix.png')    
+        confm = histogram.confusion_matrix(threshold)
+        plot_confusion_matrix(None, None, ['Unattended', 'Attended'], filename=filename+'_confusion_matrix.png', confm=confm/confm.sum())    
         X, erp, y_true, _ = next(iter(data_loader))
         X = X.to(device, dtype=torch.float)
         erp = erp.to(device, dtype=torch.float)
@@ -202,13 +367,11 @@ def fit(model:BaseNet, criterion, erp_criterion, optimizer, lr_scheduler, train_
           f'Valid loss: {best_loss_valid:.8f}\t'
           f'Valid accuracy: {100 * best_accr_valid:.2f}')
           
+    train_metrics = MetricsAccumulator(device, threshold)
+    valid_metrics = MetricsAccumulator(device, threshold)
     for epoch in range(epochs):
         model.train()
-        cur_loss = 0
-        cur_erp_loss = 0
-        cur_acc = 0
-        all_y_hat = []
-        all_y_true = []
+        train_metrics.reset()
         for (X, erp, y_true, _) in train_loader:
             # print_memory_info(device)
             if model.hybrid_training and model.feature_freeze:
@@ -217,10 +380,9 @@ def fit(model:BaseNet, criterion, erp_criterion, optimizer, lr_scheduler, train_
                 else:
                     model.freeze_feature_extractor(False)
             optimizer.zero_grad() # reset gradients
-            batch_size = y_true.shape[0]
-            X = X.to(device)
-            erp = erp.to(device)
-            y_true = y_true.to(device)
+            X = X.to(device, non_blocking=True)
+            erp = erp.to(device, non_blocking=True)
+            y_true = y_true.to(device, non_blocking=True)
             if isinstance(criterion, DualTask_AE_Loss):
                 X_pred, erp_hat, y_hat = model(X, erp, y_true)
                 loss = criterion(X_pred, y_hat, X, y_true)
@@ -229,11 +391,7 @@ def fit(model:BaseNet, criterion, erp_criterion, optimizer, lr_scheduler, train_
                 loss = criterion(y_hat, y_true)
                 
             erp_loss = erp_criterion(erp_hat, erp)
-            cur_loss += loss.item()*batch_size
-            cur_erp_loss += erp_loss.item()*batch_size
-            cur_acc += binary_accuracy(y_hat.data,y_true.data,threshold).item()*batch_size
-            all_y_hat.append(y_hat.data)
-            all_y_true.append(y_true.data)
+            train_metrics.update(y_hat, y_true, loss, erp_loss)
             
             if (model.hybrid_training) and (not(epoch%2)):
                 erp_loss.backward()
@@ -241,27 +399,19 @@ def fit(model:BaseNet, criterion, erp_criterion, optimizer, lr_scheduler, train_
                 loss.backward()
             optimizer.step()
             del X, erp, y_true, loss, erp_loss, erp_hat, y_hat
-            torch.cuda.empty_cache()
         
         lr_scheduler.step()
-        epoch_loss = cur_loss/len(train_loader.dataset)
-        train_losses.append(epoch_loss)
-        epoch_erp_loss = cur_erp_loss/len(train_loader.dataset)
-        train_erp_losses.append(epoch_erp_loss)
-        epoch_acc = cur_acc/len(train_loader.dataset)
-        train_accs.append(epoch_acc)
-        (TP,FP,TN,FN,_,_) = metrics(torch.cat(all_y_hat), torch.cat(all_y_true), thresh=threshold)
-        del all_y_hat, all_y_true
+        epoch_metrics = train_metrics.compute()
+        train_losses.append(epoch_metrics['loss'])
+        train_erp_losses.append(epoch_metrics['erp_loss'])
+        train_accs.append(epoch_metrics['acc'])
         
         model.eval()
-        cur_loss = 0
-        cur_erp_loss = 0
-        cur_acc = 0
+        valid_metrics.reset()
         for (X, erp, y_true, _) in valid_loader:
-            batch_size = y_true.shape[0]
-            X = X.to(device)
-            erp = erp.to(device)
-            y_true = y_true.to(device)    
+            X = X.to(device, non_blocking=True)
+            erp = erp.to(device, non_blocking=True)
+            y_true = y_true.to(device, non_blocking=True)
             #y_true = y_true.float()
             if isinstance(criterion, DualTask_AE_Loss):
                 X_pred, erp_hat, y_hat = model(X, erp, y_true)
@@ -270,17 +420,13 @@ def fit(model:BaseNet, criterion, erp_criterion, optimizer, lr_scheduler, train_
                 erp_hat, y_hat = model(X, erp, y_true)
                 loss = criterion(y_hat, y_true)
             erp_loss = erp_criterion(erp_hat, erp)
-            cur_loss += loss.item()*batch_size
-            cur_erp_loss += erp_loss.item()*batch_size
-            cur_acc += binary_accuracy(y_hat.data,y_true.data,threshold).item()*batch_size
+            valid_metrics.update(y_hat, y_true, loss, erp_loss)
             del X, erp, y_true, loss, erp_loss, erp_hat, y_hat
             
-        epoch_loss = cur_loss/len(valid_loader.dataset)
-        valid_losses.append(epoch_loss)
-        epoch_erp_loss = cur_erp_loss/len(valid_loader.dataset)
-        valid_erp_losses.append(epoch_erp_loss)        
-        epoch_acc = cur_acc/len(valid_loader.dataset)
-        valid_accs.append(epoch_acc)
+        valid_epoch_metrics = valid_metrics.compute()
+        valid_losses.append(valid_epoch_metrics['loss'])
+        valid_erp_losses.append(valid_epoch_metrics['erp_loss'])
+        valid_accs.append(valid_epoch_metrics['acc'])
 
         if (valid_losses[-1] <= best_loss_valid):
             logger.info(f'device {device} Checkpoint saved at epoch {epoch}.')
@@ -288,7 +434,7 @@ def fit(model:BaseNet, criterion, erp_criterion, optimizer, lr_scheduler, train_
             best_loss_valid = valid_losses[-1]
             best_accr_train = train_accs[-1]
             best_accr_valid = valid_accs[-1]
-            torch.save(model.state_dict(), model_path)
+            checkpoints.save(model.state_dict(), model_path)
             
         if (valid_erp_losses[-1] <= best_erp_loss_valid) or best_erp_loss_train<0:
             logger.info(f'device {device} Feature extractor saved at epoch {epoch}.')
@@ -297,7 +443,7 @@ def fit(model:BaseNet, criterion, erp_criterion, optimizer, lr_scheduler, train_
             head_tail = os.path.split(model_path)
             name, ext = os.path.splitext(head_tail[1])
             path = os.path.join(head_tail[0], f'{name}_erp{ext}')
-            torch.save(model.feature_extractor.state_dict(), path)            
+            checkpoints.save(model.feature_extractor.state_dict(), path)
     
         if epoch % print_every == 0:
             logger.info(f'device {device} {datetime.now().time().replace(microsecond=0)} --- '
@@ -308,7 +454,7 @@ def fit(model:BaseNet, criterion, erp_criterion, optimizer, lr_scheduler, train_
                   f'Valid erp loss: {valid_erp_losses[epoch]:.8f}\t'                  
                   f'Train accuracy: {100 * train_accs[epoch]:.2f}\t'
                   f'Valid accuracy: {100 * valid_accs[epoch]:.2f}') 
-            logger.info(f'device {device}\t\t\t TP: {TP} \t FP: {FP} \t TN: {TN} \t FN: {FN} --- F1: {2*TP/(2*TP+FP+FN):.5f}')              
+            logger.info(f'device {device}\t\t\t TP: {epoch_metrics["TP"]} \t FP: {epoch_metrics["FP"]} \t TN: {epoch_metrics["TN"]} \t FN: {epoch_metrics["FN"]} --- F1: {epoch_metrics["F1"]:.5f}')              
         torch.cuda.empty_cache()
 
     plt.clf()
@@ -335,3 +481,4 @@ def fit(model:BaseNet, criterion, erp_criterion, optimizer, lr_scheduler, train_
     filepath = os.path.join(os.path.dirname(model_path), f"{jobname}_loss_curve.png") 
     plt.savefig(filepath, dpi=300, bbox_inches='tight')
     plt.close()
+    checkpoints.flush()
@@ -93,9 +93,10 @@ def tsne_visualization(embedding, labels, filename):
     plt.savefig(filename, dpi=500, bbox_inches='tight')
     plt.close()
     
-def plot_confusion_matrix(y_true, y_predict, labels, filename, normalize='all'):
+def plot_confusion_matrix(y_true, y_predict, labels, filename, normalize='all', confm=None):
     columns = labels
-    confm = confusion_matrix(y_true, y_predict, normalize=normalize)
+    if confm is None:
+        confm = confusion_matrix(y_true, y_predict, normalize=normalize)
     if confm.shape == (1,1):
         logging.getLogger().info(confm)
         return
@@ -122,24 +123,231 @@ def binary_accuracy(y_hat, y_true, thresh=0.5):
     accuracy = (y_pred == y_true).float().mean()   
     return accuracy
     
+class MetricsAccumulator:
+    """
+    Running sums of an epoch (loss, erp loss, accuracy, TP, FP, TN, FN, count), kept in one
+    tensor on the compute device so that batches never wait for a host sync.
+    `compute` copies them to the host once, at the end of the epoch.
+    """
+    LOSS, ERP_LOSS, ACC, TP, FP, TN, FN, COUNT = range(8)
+    
+    def __init__(self, device, thresh=0.5):
+        self.thresh = thresh
+        self.sums = torch.zeros(8, dtype=torch.float64, device=device)
+        
+    def reset(self):
+        self.sums.zero_()
+        
+    def update(self, y_hat, y_true, loss=None, erp_loss=None):
+        batch_size = y_true.shape[0]
+        y_hat = y_hat.detach()
+        y_true = y_true.detach()
+        y_pred = y_hat>self.thresh
+        zero = torch.zeros((), device=self.sums.device)
+        values = (
+            loss.detach()*batch_size if loss is not None else zero,
+            erp_loss.detach()*batch_size if erp_loss is not None else zero,
+            binary_accuracy(y_hat, y_true, self.thresh)*batch_size,
+            torch.count_nonzero((y_true==1)&(y_pred==1)),
+            torch.count_nonzero((y_true==0)&(y_pred==1)),
+            torch.count_nonzero((y_true==0)&(y_pred==0)),
+            torch.count_nonzero((y_true==1)&(y_pred==0)),
+        )
+        self.sums[:self.COUNT] += torch.stack([v.to(torch.float64) for v in values])
+        self.sums[self.COUNT] += batch_size
+        
+    def compute(self):
+        sums = self.sums.tolist()
+        count = max(sums[self.COUNT], 1)
+        TP, FP, TN, FN = (int(v) for v in sums[self.TP:self.COUNT])
+        return {
+            'loss': sums[self.LOSS]/count,
+            'erp_loss': sums[self.ERP_LOSS]/count,
+            'acc': sums[self.ACC]/count,
+            'TP': TP, 'FP': FP, 'TN': TN, 'FN': FN,
+            'F1': 2*TP/(2*TP+FP+FN) if (2*TP+FP+FN) > 0 else float('nan'),
+            'count': int(sums[self.COUNT]),
+        }
+    
 def pearson_scorer(estimator, X, y):
     y_pred = estimator.predict(X)
+    return pearson_score(y, y_pred)
+    
+def pearson_score(y, y_pred):
     return scipy.stats.pearsonr(np.ravel(y), np.ravel(y_pred))[0]    
     
+def cumulative_moments(y, y_pred):
+    """Prefix sums of (count, y, y_pred, y^2, y_pred^2, y*y_pred) along the first axis.
+    
+    Returns an array (6, n+1) whose column i holds the sums over the first i rows, rows
+    with several targets are pooled like `pearson_score` does with raveled windows.
+    """
+    y = np.asarray(y, dtype=np.float64).reshape(len(y), -1)
+    y_pred = np.asarray(y_pred, dtype=np.float64).reshape(len(y_pred), -1)
+    # centering keeps the differences of large prefix sums accurate.
+    y = y - y.mean()
+    y_pred = y_pred - y_pred.mean()
+    moments = np.zeros((6, len(y)+1))
+    moments[0,1:] = y.shape[-1]
+    moments[1,1:] = y.sum(axis=-1)
+    moments[2,1:] = y_pred.sum(axis=-1)
+    moments[3,1:] = (y*y).sum(axis=-1)
+    moments[4,1:] = (y_pred*y_pred).sum(axis=-1)
+    moments[5,1:] = (y*y_pred).sum(axis=-1)
+    return np.cumsum(moments, axis=-1, out=moments)
+    
+def sliding_pearson(moments, length, starts=None, step=1):
+    """Pearson correlation of windows [start, start+length) from `cumulative_moments`.
+    
+    Arguments
+    ---------
+    moments : array (6, n+1), output of cumulative_moments.
+    length : int or int array broadcastable with starts, window length in samples.
+    starts : int array of any shape, window starts. Defaults to all windows that fit,
+        every `step` samples.
+        
+    Returns
+    -------
+    r : array of starts' shape, NaN where one of the windows is constant.
+    """
+    if starts is None:
+        starts = np.arange(0, moments.shape[-1]-length, step)
+    starts = np.asarray(starts)
+    n, sy, sp, syy, spp, syp = moments[:, starts+length] - moments[:, starts]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = n*syp - sy*sp
+        var = (n*syy - sy*sy)*(n*spp - sp*sp)
+        return np.where(var > 0, cov/np.sqrt(np.maximum(var, 0)), np.nan)
+    
+# thresholds tried by `metrics`, from 0.5 outwards: 0.5, 0.49, 0.51, 0.48, ...
+THRESHOLD_GRID = [0.5 + ((-1)**i)*0.01*int((i+1)/2) for i in range(100)]
+
+def threshold_search(y_hat, y_true, thresholds=None):
+    """
+    Sort the scores once and count TP/FP/TN/FN of every threshold with cumulative sums,
+    predictions being y_hat>thr as in `metrics`. By default every cut point between the
+    sorted scores is tried, otherwise the given thresholds (ties go to the first one).
+    Returns a dict with the best accuracy 'threshold' and its 'acc', 'balanced_acc' and
+    confusion counts, the F1-optimal 'f1_threshold' and 'F1', and the ROC 'auc'.
+    """
+    scores = y_hat.detach().flatten()
+    labels = y_true.detach().flatten()
+    scores, order = torch.sort(scores)
+    labels = labels[order]
+    zero = torch.zeros(1, dtype=torch.int64, device=scores.device)
+    pos_le = torch.cat((zero, torch.cumsum(labels==1, 0))) # positives with score <= cut
+    neg_le = torch.cat((zero, torch.cumsum(labels==0, 0)))
+    # every cut point, from all predicted positive (below the lowest score) to none
+    cuts = torch.unique_consecutive(scores)
+    below = torch.nextafter(cuts[:1], torch.full_like(cuts[:1], -float('inf')))
+    cuts = torch.cat((below, cuts))
+    cut_idx = torch.searchsorted(scores, cuts, right=True)
+    if thresholds is None:
+        idx = cut_idx
+    else:
+        idx = torch.searchsorted(scores, torch.as_tensor(thresholds, dtype=scores.dtype, device=scores.device), right=True)
+    return _search_cuts(pos_le, neg_le, len(scores), cut_idx, idx, cuts if thresholds is None else thresholds)
+    
+def _search_cuts(pos_le, neg_le, total, cut_idx, idx, thresholds):
+    """
+    pos_le/neg_le: cumulative counts of positives/negatives predicted negative at each cut,
+    cut_idx: every cut of the ROC curve, idx: the cuts of the candidate thresholds.
+    """
+    P, N = pos_le[-1], neg_le[-1]
+    tpr = (P-pos_le[cut_idx]).double()/P
+    fpr = (N-neg_le[cut_idx]).double()/N
+    auc = torch.trapezoid(tpr.flip(0), fpr.flip(0))
+    FN, TN = pos_le[idx], neg_le[idx]
+    TP, FP = P-FN, N-TN
+    best = torch.argmax(TP+TN) # first max
+    f1 = (2*TP).double()/(2*TP+FP+FN).clamp(min=1)
+    best_f1 = torch.argmax(f1)
+    F1, auc = torch.stack((f1[best_f1], auc)).tolist()
+    TP, FP, TN, FN, P, N, best, best_f1 = torch.stack((TP[best], FP[best], TN[best], FN[best], P, N, best, best_f1)).tolist()
+    if torch.is_tensor(thresholds):
+        thresholds = thresholds[[best, best_f1]].tolist()
+        best, best_f1 = 0, 1
+    return {
+        'threshold': thresholds[best],
+        'acc': (TP+TN)/total,
+        'balanced_acc': (TP/P + TN/N)/2 if P > 0 and N > 0 else float('nan'),
+        'TP': TP, 'FP': FP, 'TN': TN, 'FN': FN,
+        'f1_threshold': thresholds[best_f1],
+        'F1': F1,
+        'auc': auc,
+    }
+    
+class ScoreHistogram:
+    """
+    Streaming evaluation of a binary classifier: the scores y_hat of the negatives, the
+    positives and the other (soft) labels are binned on fixed edges as batches arrive, so
+    memory does not grow with the test set. A score goes to the bin of the first edge >= it,
+    hence the counts of y_hat>edge are exact at every edge. The edges are a `resolution`
+    grid over [lo, hi], THRESHOLD_GRID and the given extra thresholds.
+    The soft labels are also counted on a `label_resolution` grid over [0, 1], so the
+    distinct soft label values are only resolved by `metrics`.
+    """
+    def __init__(self, device='cpu', resolution=1e-3, lo=0.0, hi=1.0, extra=(), label_resolution=1e-4):
+        edges = np.concatenate((np.arange(lo, hi+resolution/2, resolution), THRESHOLD_GRID, np.asarray(extra, dtype=float).ravel()))
+        self.edges = torch.as_tensor(np.unique(edges.astype(np.float32)), device=device)
+        self.counts = torch.zeros((3, len(self.edges)+1), dtype=torch.int64, device=device)
+        # soft label counts, each distinct value is a class of the weighted accuracy.
+        self.label_bins = int(round(1/label_resolution))
+        self.soft_counts = torch.zeros(self.label_bins+1, dtype=torch.int64, device=device)
+        
+    def update(self, y_hat, y_true):
+        bins = torch.bucketize(y_hat.detach().flatten().to(self.edges.dtype), self.edges)
+        y_true = y_true.detach().flatten()
+        rows = torch.where(y_true==0, 0, torch.where(y_true==1, 1, 2))
+        flat = rows*self.counts.shape[1] + bins
+        self.counts.view(-1).scatter_add_(0, flat, torch.ones_like(flat))
+        labels = torch.round(y_true.clamp(0, 1)*self.label_bins).long()
+        self.soft_counts.scatter_add_(0, labels, (rows==2).long())
+        
+    def search(self, thresholds=None):
+        """
+        `threshold_search` on the histogram, over all edges or over the given thresholds
+        which must be edges. The AUC counts the scores within a bin as ties.
+        """
+        zero = torch.zeros(1, dtype=torch.int64, device=self.counts.device)
+        neg_le = torch.cat((zero, torch.cumsum(self.counts[0], 0)))
+        pos_le = torch.cat((zero, torch.cumsum(self.counts[1], 0)))
+        total = int(self.counts.sum())
+        cut_idx = torch.arange(len(neg_le), device=self.counts.device)
+        if thresholds is None:
+            return _search_cuts(pos_le, neg_le, total, cut_idx, cut_idx[1:-1], self.edges)
+        thr = torch.as_tensor(thresholds, dtype=self.edges.dtype, device=self.edges.device)
+        idx = torch.searchsorted(self.edges, thr)
+        if not torch.equal(self.edges[idx.clamp(max=len(self.edges)-1)], thr):
+            raise ValueError(f'Thresholds {thresholds} are not histogram edges.')
+        return _search_cuts(pos_le, neg_le, total, cut_idx, idx+1, thresholds)
+        
+    def metrics(self, thresh=None, weighted=False):
+        """
+        Same outputs as `metrics(y_hat, y_true, thresh, weighted)` on the binned predictions.
+        As there, the weighted accuracy averages the recalls of every label value, the soft
+        labels never equal a hard prediction and count as classes of recall 0.
+        """
+        result = self.search(THRESHOLD_GRID if thresh is None else [thresh])
+        TP, FP, TN, FN = result['TP'], result['FP'], result['TN'], result['FN']
+        acc = result['acc']
+        if weighted:
+            recalls = [TN/(TN+FP)] if TN+FP > 0 else []
+            recalls += [TP/(TP+FN)] if TP+FN > 0 else []
+            recalls += [0.0]*int(torch.count_nonzero(self.soft_counts))
+            acc = float(np.mean(recalls))
+        return (TP, FP, TN, FN, acc, result['threshold'])
+        
+    def confusion_matrix(self, thresh):
+        """[[TN, FP], [FN, TP]] at thresh, restricted to the classes that occur."""
+        result = self.search([thresh])
+        confm = np.array([[result['TN'], result['FP']], [result['FN'], result['TP']]])
+        present = (confm.sum(axis=0) + confm.sum(axis=1)) > 0
+        return confm[present][:, present]
+    
 def metrics(y_hat,y_true, thresh=None, weighted=False):
     if (thresh is None):
-        max_acc = 0
-        for i in range(100):
-            thr = 0.5 + ((-1)**i)*0.01*int((i+1)/2)
-            y_pred = y_hat>thr
-            true_pos = torch.count_nonzero((y_true==1)&(y_pred==1))
-            false_pos = torch.count_nonzero((y_true==0)&(y_pred==1))
-            true_neg = torch.count_nonzero((y_true==0)&(y_pred==0))
-            false_neg = torch.count_nonzero((y_true==1)&(y_pred==0))
-            acc = (true_pos+true_neg)/len(y_hat)
-            if acc>max_acc:
-                max_acc = acc
-                thresh = thr
+        thresh = threshold_search(y_hat, y_true, THRESHOLD_GRID)['threshold']
     y_pred = y_hat>thresh
     true_pos = torch.count_nonzero((y_true==1)&(y_pred==1))
     false_pos = torch.count_nonzero((y_true==0)&(y_pred==1))